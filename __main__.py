@@ -0,0 +1,42 @@
+"""
+Apwal standalone server
+
+    python -m apwal [options] [document_root]
+"""
+
+import sys
+from optparse import OptionParser
+from apwal.http.prefork import PreforkServer
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [document_root]')
+    parser.add_option('-b', '--bind', default='127.0.0.1:8000',
+        help='address to listen on, as host:port (default: %default)')
+    parser.add_option('-w', '--workers', type='int', default=0,
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_option('-t', '--threads', type='int', default=10,
+        help='application threads per worker (default: %default)')
+    parser.add_option('-c', '--config', default='config.xml',
+        help='configuration file, relative to the document root (default: %default)')
+    parser.add_option('--max-requests', type='int', default=0,
+        help='restart workers after this many requests (default: never)')
+    parser.add_option('--keepalive', type='int', default=15,
+        help='keep-alive timeout, in seconds (default: %default)')
+    parser.add_option('--graceful-timeout', type='int', default=30,
+        help='time given to workers to finish their requests on reload or stop (default: %default)')
+    options, args = parser.parse_args(argv)
+    if len(args) > 1:
+        parser.error('too many arguments')
+    host, sep, port = options.bind.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        parser.error('invalid address: %s' % options.bind)
+    server = PreforkServer(args and args[0] or '.', host=host or '127.0.0.1', port=port,
+        workers=options.workers, threads=options.threads, config_file=options.config,
+        max_requests=options.max_requests, keepalive_timeout=options.keepalive,
+        graceful_timeout=options.graceful_timeout)
+    server.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+"""
+Apwal micro-benchmarks
+
+Each module can be run on its own, e.g. python -m apwal.bench.routing
+"""
@@ -0,0 +1,80 @@
+"""
+Configuration loading benchmark: time to load config.xml files of
+increasing size (vhosts of PLUGS plugs with a few parameters each), with
+the former minidom loader as the baseline, the incremental parser, and the
+compiled snapshot.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from xml.dom.minidom import parse
+from apwal.core.settings import Settings, SettingsLoader
+
+VHOSTS = (10, 100, 1000)
+PLUGS = 10
+
+def legacy_read(cfg_file):
+    """
+    SettingsLoader.read as it was: full DOM, walked with getElementsByTagName
+    """
+    cfg = parse(cfg_file)
+    vhosts = {}
+    for vhost in cfg.getElementsByTagName('vhost'):
+        vhost_name = vhost.getAttribute('name')
+        if vhost_name:
+            vhost_plugs = []
+            for plug in vhost.getElementsByTagName('plug'):
+                plug_params = {}
+                for param in plug.getElementsByTagName('param'):
+                    plug_params[param.getAttribute('name')] = param.getAttribute('value')
+                vhost_plugs.append({'src':plug.getAttribute('src'), 'route':plug.getAttribute('route'), 'params':plug_params})
+            vhosts[vhost_name] = vhost_plugs
+    return vhosts
+
+def write_config(path, vhosts):
+    f = open(path, 'w')
+    f.write('<config>\n')
+    for i in xrange(vhosts):
+        f.write('\t<vhost name="site%d.example.com">\n' % i)
+        for j in xrange(PLUGS):
+            f.write('\t\t<plug src="module%d" route="/section%d">\n' % (j, j))
+            f.write('\t\t\t<param name="directory" value="/var/www/site%d/section%d/"/>\n' % (i, j))
+            f.write('\t\t\t<param name="allow" value="png,jpg,gif"/>\n')
+            f.write('\t\t</plug>\n')
+        f.write('\t</vhost>\n')
+    f.write('</config>\n')
+    f.close()
+
+def measure(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def load(cfg_file, snapshot):
+    Settings.globals['config_snapshot'] = snapshot
+    return SettingsLoader(cfg_file).read()
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or VHOSTS
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print '%8s %8s %14s %14s %14s' % ('vhosts', 'plugs', 'minidom (ms)', 'iterparse (ms)', 'snapshot (ms)')
+        for vhosts in sizes:
+            cfg_file = os.path.join(tmpdir, 'config-%d.xml' % vhosts)
+            write_config(cfg_file, vhosts)
+            legacy = measure(lambda: legacy_read(cfg_file))
+            streamed = measure(lambda: load(cfg_file, False))
+            # first load writes the snapshot
+            load(cfg_file, True)
+            snapshot = measure(lambda: load(cfg_file, True))
+            print '%8d %8d %14.1f %14.1f %14.1f' % (vhosts, vhosts * PLUGS, legacy, streamed, snapshot)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,84 @@
+"""
+Static files memory benchmark: serves files of increasing size through
+WSGIHandler and MediaServer, and reports the peak memory (RSS) of the
+serving process, compared to loading the whole file in an HttpResponse as
+MediaServer formerly did.
+
+Each measure runs in a forked process, as peak RSS never decreases.
+"""
+
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from wsgiref.util import FileWrapper
+from apwal.core.handler import WSGIHandler
+from apwal.http import HttpResponse
+
+FILE_SIZES = (1, 16, 64, 256) # in MB
+
+CONFIG = """<vhost name="localhost">
+	<plug src="apwal.tools.medias" route="/medias">
+		<param name="directory" value="%s"/>
+	</plug>
+</vhost>
+"""
+
+def environ(wwwroot, path, file_wrapper=False):
+    env = {
+        'DOCUMENT_ROOT': wwwroot,
+        'SERVER_NAME': 'localhost',
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'wsgi.input': StringIO(),
+        'wsgi.url_scheme': 'http',
+    }
+    if file_wrapper:
+        env['wsgi.file_wrapper'] = FileWrapper
+    return env
+
+def start_response(status, headers):
+    pass
+
+def serve_legacy(wwwroot, path):
+    response = HttpResponse(open(os.path.join(wwwroot, path.lstrip('/')), 'rb').read())
+    return [response.content]
+
+def serve(wwwroot, path, file_wrapper=False):
+    return WSGIHandler()(environ(wwwroot, path, file_wrapper), start_response)
+
+def peak_rss(serve_func, *args):
+    """
+    Consume a response in a child process, and return the child's peak RSS
+    in MB
+    """
+    pid = os.fork()
+    if pid == 0:
+        body = serve_func(*args)
+        for chunk in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+        os._exit(0)
+    pid, status, usage = os.wait4(pid, 0)
+    return usage.ru_maxrss / 1024.0
+
+if __name__ == '__main__':
+    wwwroot = tempfile.mkdtemp()
+    try:
+        open(os.path.join(wwwroot, 'config.xml'), 'w').write(CONFIG % wwwroot)
+        print '%10s %15s %15s %15s' % ('size (MB)', 'legacy (MB)', 'chunked (MB)', 'wrapper (MB)')
+        for size in FILE_SIZES:
+            media = open(os.path.join(wwwroot, 'media.bin'), 'wb')
+            for i in range(size):
+                media.write('\0' * 1024 * 1024)
+            media.close()
+            print '%10d %15.1f %15.1f %15.1f' % (
+                size,
+                peak_rss(serve_legacy, wwwroot, '/media.bin'),
+                peak_rss(serve, wwwroot, '/medias/media.bin'),
+                peak_rss(serve, wwwroot, '/medias/media.bin', True),
+            )
+    finally:
+        shutil.rmtree(wwwroot)
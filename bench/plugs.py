@@ -0,0 +1,67 @@
+"""
+Pluggables loading benchmark: dispatcher construction time and number of
+module executions for a config.xml plugging the same source at PLUGS
+routes, compared to the former loader executing the module once per plug.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from imp import find_module, load_module
+import apwal.core.handler
+from apwal.core.handler import ApwalDispatcher
+from apwal.core.utils import ModuleCache
+
+PLUGS = (1, 10, 100)
+
+# module with some top-level initialization work (think of templates or
+# lookup tables built at import time)
+PLUGGABLE = """from apwal import *
+from apwal.http import HttpResponse
+
+TABLE = dict([(i, str(i)) for i in xrange(100000)])
+
+@main
+class Page(Pluggable):
+
+%s
+""" % '\n'.join(["""	@bind('/page%d/{id:([0-9]+)}')
+	def page%d(self, urlparams):
+		return HttpResponse(urlparams['id'])
+""" % (i, i) for i in range(5)])
+
+class LegacyLoader(ModuleCache):
+    """
+    Former behaviour: find_module/load_module on every plug
+    """
+    def load(self, name, path=None):
+        f, pathname, description = find_module(name, path)
+        try:
+            self.imports += 1
+            return load_module(name, f, pathname, description)
+        finally:
+            if f:
+                f.close()
+
+def build(wwwroot, loader):
+    apwal.core.handler.module_cache = loader
+    start = time.time()
+    ApwalDispatcher(wwwroot)
+    return (time.time() - start) * 1000, loader.imports
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or PLUGS
+    wwwroot = tempfile.mkdtemp()
+    try:
+        open(os.path.join(wwwroot, 'page.py'), 'w').write(PLUGGABLE)
+        print '%8s %14s %14s %14s %14s' % ('plugs', 'legacy (ms)', 'imports', 'cached (ms)', 'imports')
+        for plugs in sizes:
+            config = open(os.path.join(wwwroot, 'config.xml'), 'w')
+            config.write('<vhost name="localhost">\n%s</vhost>\n' % ''.join(
+                ['\t<plug src="page" route="/site%d"/>\n' % i for i in range(plugs)]))
+            config.close()
+            print '%8d %14.1f %14d %14.1f %14d' % ((plugs,) + build(wwwroot, LegacyLoader()) + build(wwwroot, ModuleCache()))
+    finally:
+        shutil.rmtree(wwwroot)
@@ -0,0 +1,68 @@
+"""
+Query string and form body parsing benchmark: time to parse large query
+strings, with distinct or repeated keys, reading every value through a
+QueryDict or a single key through a lazy QueryString, and urlencoded form
+bodies read through WSGIRequest.POST. The former QueryDict, parsed with
+parse_qsl and with its copying appendlist, is the baseline.
+"""
+
+import gc
+import sys
+import time
+from StringIO import StringIO
+from apwal.core.utils import MultiValueDict, QueryDict, QueryString, parse_qsl
+from apwal.http import WSGIRequest
+
+SIZES = (100, 1000, 10000)
+
+class LegacyQueryDict(MultiValueDict):
+    """
+    QueryDict as it was, eagerly parsed and appending values by copying lists
+    """
+    def __init__(self, query_string):
+        MultiValueDict.__init__(self)
+        for key, value in parse_qsl(query_string, True):
+            list_ = self.getlist(key)
+            dict.__setitem__(self, key, list_ + [value])
+
+def query_strings(size):
+    return (
+        ('distinct', '&'.join(['key%d=value%%20%d' % (i, i) for i in xrange(size)])),
+        ('repeated', '&'.join(['ids=%d' % i for i in xrange(size)])),
+    )
+
+def measure(func, arg, repeat=5):
+    best = None
+    for _ in range(repeat):
+        gc.disable()
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def read_all(qs):
+    return QueryDict(qs).lists()
+
+def read_one(qs):
+    return QueryString(qs).get('ids')
+
+def parse_form(body):
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': StringIO(body),
+    }
+    return WSGIRequest(environ).POST.lists()
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print '%8s %10s %12s %12s %12s %12s' % ('keys', 'shape', 'legacy (ms)', 'all (ms)', 'lazy (ms)', 'form (ms)')
+    for size in sizes:
+        for shape, qs in query_strings(size):
+            print '%8d %10s %12.2f %12.2f %12.2f %12.2f' % (size, shape, measure(LegacyQueryDict, qs),
+                measure(read_all, qs), measure(read_one, qs), measure(parse_form, qs))
@@ -0,0 +1,58 @@
+"""
+Route matching micro-benchmark: compares the per-route regexp loop formerly
+used by Pluggable.findRoute with the compiled RouteTable and the RouteTrie,
+for an increasing number of routes.
+"""
+
+import re
+import timeit
+from apwal.core.router import RouteTable, RouteTrie
+
+ROUTE_COUNTS = (10, 100, 500, 1000, 5000)
+# number of lookups per measure, scaled down as route count grows
+LOOKUPS = 20000
+
+def handler(urlparams=None):
+    return urlparams
+
+def build_routes(count):
+    """
+    Build routes looking like what Pluggable generates: half static, half
+    with a dynamic parameter
+    """
+    routes = []
+    for i in range(count):
+        if i % 2:
+            routes.append(('/app%d/user/(?P<id>[0-9]+)' % i, handler))
+        else:
+            routes.append(('/app%d/index' % i, handler))
+    return routes
+
+def legacy_match(routes, requestedUrl):
+    for url, method in routes:
+        res = re.match('^%s$' % url, requestedUrl)
+        if res:
+            return method, res.groupdict()
+    return None
+
+def bench(count):
+    routes = build_routes(count)
+    table = RouteTable(routes)
+    table.compile()
+    trie = RouteTrie(routes)
+    trie.compile()
+    # worst case for a linear scan: the last declared route
+    url = '/app%d/user/42' % (count - 1)
+    assert legacy_match(routes, url)[1] == table.resolve(url)[1] == trie.resolve(url)[1]
+    number = max(10, LOOKUPS // count)
+    timings = (
+        timeit.timeit(lambda: legacy_match(routes, url), number=number),
+        timeit.timeit(lambda: table.resolve(url), number=number),
+        timeit.timeit(lambda: trie.resolve(url), number=number),
+    )
+    return [timing / number * 1e6 for timing in timings]
+
+if __name__ == '__main__':
+    print '%8s %15s %15s %15s' % ('routes', 'legacy (us)', 'compiled (us)', 'trie (us)')
+    for count in ROUTE_COUNTS:
+        print '%8d %15.2f %15.2f %15.2f' % tuple([count] + bench(count))
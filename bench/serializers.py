@@ -0,0 +1,47 @@
+"""
+Session serializers benchmark: serialization and deserialization time,
+and payload size, of representative session payloads for each serializer,
+the former protocol 0 pickle being the baseline.
+"""
+
+import timeit
+from apwal.core.session import Session, PickleSerializer, MarshalSerializer, \
+    JSONSerializer, CompressedSerializer
+
+ITERATIONS = 2000
+
+SERIALIZERS = (
+    ('pickle (proto 0)', PickleSerializer(0)),
+    ('pickle', PickleSerializer()),
+    ('marshal', MarshalSerializer()),
+    ('json', JSONSerializer()),
+    ('pickle+zlib', CompressedSerializer(PickleSerializer())),
+    ('marshal+zlib', CompressedSerializer(MarshalSerializer())),
+)
+
+def payloads():
+    """
+    Small (authenticated user), medium (shopping cart) and large (browsing
+    history) sessions
+    """
+    small = Session(store=object())
+    small['user_id'] = 4242
+    small['username'] = 'goofy'
+    small['is_admin'] = False
+    medium = Session(store=object())
+    medium['user_id'] = 4242
+    medium['cart'] = [{'sku': 'SKU-%05d' % i, 'quantity': i % 3 + 1, 'price': 9.99 * i} for i in range(20)]
+    large = Session(store=object())
+    large['user_id'] = 4242
+    large['history'] = ['/products/category-%d/item-%d?ref=home' % (i % 12, i) for i in range(500)]
+    return (('small', small.toArray()), ('medium', medium.toArray()), ('large', large.toArray()))
+
+if __name__ == '__main__':
+    print '%8s %18s %12s %12s %10s' % ('payload', 'serializer', 'dumps (us)', 'loads (us)', 'bytes')
+    for payload_name, array in payloads():
+        for name, serializer in SERIALIZERS:
+            data = serializer.dumps(array)
+            dumps = timeit.timeit(lambda: serializer.dumps(array), number=ITERATIONS)
+            loads = timeit.timeit(lambda: serializer.loads(data), number=ITERATIONS)
+            print '%8s %18s %12.1f %12.1f %10d' % (payload_name, name,
+                dumps / ITERATIONS * 1e6, loads / ITERATIONS * 1e6, len(data))
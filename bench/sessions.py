@@ -0,0 +1,80 @@
+"""
+Session load benchmark: average latency of FileSystemStore.load() for an
+increasing number of stored sessions, compared to the former load() which
+swept the whole store (unpickling every session) before each load.
+
+Usage: python -m apwal.bench.sessions [count ...]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import tempfile
+from apwal.core.session import Session, FileSystemStore, pickle
+
+SESSION_COUNTS = (100, 1000, 10000, 100000)
+LOADS = 1000
+# the former load() is too slow to be measured beyond this count
+LEGACY_MAX = 10000
+
+def legacy_load(store, root, uuid):
+    for session in os.listdir(root):
+        session_file = os.path.join(root, session)
+        if re.match('^[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}$', session):
+            session = Session.fromArray(pickle.load(open(session_file, 'r')), store)
+            if session.isExpired():
+                os.remove(session_file)
+    if uuid in os.listdir(root):
+        return Session.fromArray(pickle.load(open(os.path.join(root, uuid), 'r')), store)
+
+def populate(store, count):
+    uuids = []
+    for i in range(count):
+        session = Session(store)
+        session['user'] = 'user%d' % i
+        session.save()
+        uuids.append(str(session.uuid))
+    return uuids
+
+def populate_flat(store, root, count):
+    """
+    Store sessions in the root directory, as the former store did
+    """
+    uuids = []
+    for i in range(count):
+        session = Session(store)
+        session['user'] = 'user%d' % i
+        pickle.dump(session.toArray(), open(os.path.join(root, str(session.uuid)), 'w'))
+        uuids.append(str(session.uuid))
+    return uuids
+
+def average(func, store, root, uuids, loads):
+    start = time.time()
+    for i in range(loads):
+        func(store, root, random.choice(uuids))
+    return (time.time() - start) / loads * 1e6
+
+def load(store, root, uuid):
+    return store.load(uuid)
+
+if __name__ == '__main__':
+    counts = [int(count) for count in sys.argv[1:]] or SESSION_COUNTS
+    print '%10s %15s %15s' % ('sessions', 'legacy (us)', 'load (us)')
+    for count in counts:
+        root = tempfile.mkdtemp()
+        try:
+            store = FileSystemStore(root)
+            if count <= LEGACY_MAX:
+                uuids = populate_flat(store, root, count)
+                legacy = '%15.1f' % average(legacy_load, store, root, uuids, max(1, LOADS // count))
+                shutil.rmtree(root)
+                os.mkdir(root)
+            else:
+                legacy = '%15s' % '-'
+            uuids = populate(store, count)
+            print '%10d %s %15.1f' % (count, legacy, average(load, store, root, uuids, LOADS))
+        finally:
+            shutil.rmtree(root)
@@ -0,0 +1,65 @@
+"""
+Session stores benchmark: compares FileSystemStore and SQLiteStore save,
+load and cleanup costs for an increasing number of stored sessions, a
+tenth of them being expired.
+
+Usage: python -m apwal.bench.stores [count ...]
+"""
+
+import sys
+import time
+import random
+import shutil
+import os.path
+import tempfile
+from apwal.core.session import Session, FileSystemStore, SQLiteStore
+
+SESSION_COUNTS = (10000, 100000, 1000000)
+LOADS = 1000
+
+def populate(store, count):
+    """
+    Store count sessions, returning the uuids of non expired ones
+    """
+    uuids = []
+    expired = int(time.time()) - 1
+    for i in range(count):
+        session = Session(store)
+        session['user'] = 'user%d' % i
+        session['cart'] = range(i % 10)
+        if i % 10 == 0:
+            session.timeout = expired
+        else:
+            uuids.append(str(session.uuid))
+        session.save()
+    return uuids
+
+def bench(store, count):
+    # never clean up while loading, cleanup is measured on its own
+    store.sweep_interval = LOADS * 2
+    start = time.time()
+    uuids = populate(store, count)
+    save = (time.time() - start) / count * 1e6
+    start = time.time()
+    for i in range(LOADS):
+        assert store.load(random.choice(uuids)) is not None
+    load = (time.time() - start) / LOADS * 1e6
+    start = time.time()
+    store.cleanup()
+    cleanup = (time.time() - start) * 1e3
+    return save, load, cleanup
+
+if __name__ == '__main__':
+    counts = [int(count) for count in sys.argv[1:]] or SESSION_COUNTS
+    print '%10s %12s %12s %12s %12s' % ('sessions', 'store', 'save (us)', 'load (us)', 'cleanup (ms)')
+    for count in counts:
+        for name in ('filesystem', 'sqlite'):
+            root = tempfile.mkdtemp()
+            try:
+                if name == 'filesystem':
+                    store = FileSystemStore(root)
+                else:
+                    store = SQLiteStore(os.path.join(root, 'sessions.db'))
+                print '%10d %12s %12.1f %12.1f %12.1f' % ((count, name) + bench(store, count))
+            finally:
+                shutil.rmtree(root)
@@ -0,0 +1,101 @@
+"""
+Streamed responses benchmark: serves a generated body of increasing size
+(64KB chunks, each taking a little time to produce) through WSGIHandler,
+and reports the time to first byte and the peak memory (RSS) of the serving
+process, compared to joining the whole body as WSGIHandler formerly did.
+
+Each measure runs in a forked process, as peak RSS never decreases.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from StringIO import StringIO
+from apwal.core.handler import WSGIHandler
+
+BODY_SIZES = (1, 16, 64, 256) # in MB
+
+CHUNK_SIZE = 64*1024
+
+CONFIG = """<vhost name="localhost">
+	<plug src="streamer" route="/"/>
+</vhost>
+"""
+
+PLUGGABLE = """from apwal import *
+from apwal.http import HttpResponse
+import time
+
+@main
+class Streamer(Pluggable):
+
+	@bind('/{size:([0-9]+)}')
+	def stream(self, urlparams):
+		def body(chunks):
+			for i in xrange(chunks):
+				time.sleep(0.0001)
+				yield 'x' * %d
+		return HttpResponse(body(int(urlparams['size']) * 16))
+""" % CHUNK_SIZE
+
+def environ(wwwroot, path):
+    return {
+        'DOCUMENT_ROOT': wwwroot,
+        'SERVER_NAME': 'localhost',
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'wsgi.input': StringIO(),
+        'wsgi.url_scheme': 'http',
+    }
+
+def start_response(status, headers):
+    pass
+
+def serve_legacy(wwwroot, path):
+    return [''.join(WSGIHandler()(environ(wwwroot, path), start_response))]
+
+def serve(wwwroot, path):
+    return WSGIHandler()(environ(wwwroot, path), start_response)
+
+def measure(serve_func, *args):
+    """
+    Consume a response in a child process, and return the time to first
+    byte in ms and the child's peak RSS in MB
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        start = time.time()
+        body = serve_func(*args)
+        ttfb = None
+        for chunk in body:
+            if ttfb is None:
+                ttfb = time.time() - start
+        if hasattr(body, 'close'):
+            body.close()
+        os.write(write, '%f' % ttfb)
+        os._exit(0)
+    os.close(write)
+    ttfb = float(os.read(read, 64))
+    os.close(read)
+    pid, status, usage = os.wait4(pid, 0)
+    return ttfb * 1000, usage.ru_maxrss / 1024.0
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or BODY_SIZES
+    wwwroot = tempfile.mkdtemp()
+    try:
+        open(os.path.join(wwwroot, 'config.xml'), 'w').write(CONFIG)
+        open(os.path.join(wwwroot, 'streamer.py'), 'w').write(PLUGGABLE)
+        print '%10s %18s %18s %18s %18s' % ('size (MB)', 'legacy ttfb (ms)', 'legacy rss (MB)',
+            'stream ttfb (ms)', 'stream rss (MB)')
+        for size in sizes:
+            path = '/%d' % size
+            print '%10d %18.1f %18.1f %18.1f %18.1f' % ((size,)
+                + measure(serve_legacy, wwwroot, path) + measure(serve, wwwroot, path))
+    finally:
+        shutil.rmtree(wwwroot)
@@ -0,0 +1,100 @@
+"""
+File upload benchmark: parses multipart/form-data bodies holding a file of
+increasing size, and reports parsing throughput and peak memory (RSS) of
+the parsing process, for the former email module based parser (which
+needed the whole body in memory) and the streaming MultiPartParser.
+
+Each measure runs in a forked process, as peak RSS never decreases.
+"""
+
+import os
+import time
+from apwal.http import MultiPartParser
+from apwal.core.utils import MultiValueDict
+
+FILE_SIZES = (1, 16, 64, 256) # in MB
+BOUNDARY = '----ApwalBenchBoundary'
+CONTENT_TYPE = 'multipart/form-data; boundary=%s' % BOUNDARY
+
+class UploadStream(object):
+    """
+    wsgi.input like stream generating a multipart body on the fly
+    """
+    def __init__(self, size):
+        self.head = '--%s\r\nContent-Disposition: form-data; name="title"\r\n\r\nholidays\r\n' % BOUNDARY
+        self.head += '--%s\r\nContent-Disposition: form-data; name="video"; filename="video.bin"\r\n' % BOUNDARY
+        self.head += 'Content-Type: application/octet-stream\r\n\r\n'
+        self.tail = '\r\n--%s--\r\n' % BOUNDARY
+        self.size = size
+        self.length = len(self.head) + size + len(self.tail)
+        self.position = 0
+        self.block = 'x' * (1024 * 1024)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length - self.position
+        chunks = []
+        while size > 0 and self.position < self.length:
+            if self.position < len(self.head):
+                chunk = self.head[self.position:self.position+size]
+            elif self.position < len(self.head) + self.size:
+                offset = self.position - len(self.head)
+                chunk = self.block[:min(size, self.size - offset, len(self.block))]
+            else:
+                offset = self.position - len(self.head) - self.size
+                chunk = self.tail[offset:offset+size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+def legacy_parse(stream):
+    """
+    Former parse_file_upload(), reading the whole body first
+    """
+    import email, email.Message
+    from cgi import parse_header
+    post_data = stream.read()
+    raw_message = 'Content-Type:%s' % CONTENT_TYPE
+    raw_message += '\r\n\r\n' + post_data
+    msg = email.message_from_string(raw_message)
+    POST = MultiValueDict()
+    FILES = MultiValueDict()
+    for submessage in msg.get_payload():
+        if submessage and isinstance(submessage, email.Message.Message):
+            name_dict = parse_header(submessage['Content-Disposition'])[1]
+            if name_dict.has_key('filename'):
+                FILES.appendlist(name_dict['name'], {
+                    'filename': name_dict['filename'],
+                    'content-type': submessage['Content-Type'],
+                    'content': submessage.get_payload(),
+                })
+            else:
+                POST.appendlist(name_dict['name'], submessage.get_payload())
+    return POST, FILES
+
+def streaming_parse(stream):
+    return MultiPartParser(stream, CONTENT_TYPE, stream.length).parse()
+
+def measure(parse, size):
+    """
+    Parse an upload in a child process, returning (MB/s, peak RSS in MB)
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        start = time.time()
+        POST, FILES = parse(UploadStream(size * 1024 * 1024))
+        os.write(write_fd, '%f' % (time.time() - start))
+        os._exit(0)
+    os.close(write_fd)
+    elapsed = float(os.read(read_fd, 64))
+    os.close(read_fd)
+    pid, status, usage = os.wait4(pid, 0)
+    return size / elapsed, usage.ru_maxrss / 1024.0
+
+if __name__ == '__main__':
+    print '%10s %14s %14s %14s %14s' % ('size (MB)', 'legacy (MB/s)', 'legacy (MB)', 'stream (MB/s)', 'stream (MB)')
+    for size in FILE_SIZES:
+        print '%10d %14.1f %14.1f %14.1f %14.1f' % ((size,) + measure(legacy_parse, size) + measure(streaming_parse, size))
@@ -26,4 +26,10 @@ class ExternalRedirect(InternalRedirect):
 	pass
 
 class ForbiddenAccess(Exception):
+	pass
+
+class RequestEntityTooLarge(Exception):
+	"""
+	Request body (or one of its fields) exceeds configured size limits
+	"""
 	pass
\ No newline at end of file
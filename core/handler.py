@@ -5,39 +5,69 @@ import re
 import traceback
 import sys
 import os
-from imp import find_module, load_module
+import time
+from threading import local, Lock
 
 try:
 	from mod_python import apache, Session
 except ImportError,e:
 	pass
 from apwal.core.exceptions import *
-from apwal.core.settings import SettingsLoader
+from apwal.core.settings import Settings, SettingsLoader, config_stamp
 from apwal.core.helpers import is_handler
-from apwal.http import ModPythonRequest,HttpRequest, HttpResponse, Http404, WSGIRequest
-from apwal.core.utils import DebugMsg,load_tool
+from apwal.http import ModPythonRequest,HttpRequest, HttpResponse, HttpFileResponse, Http404, WSGIRequest
+from apwal.core.utils import DebugMsg,ThreadProxy,load_tool,module_cache
+from apwal.core.router import RouteTrie
+from apwal.http.compression import Compressor
 
 __all__ = [
 	'ApwalDispatcher',
+	'DispatcherCache',
 	'handler',
 	'WSGIHandler',
 ]
 
 class ApwalDispatcher:
 
-	def __init__(self, req,config_file='config.xml'):
-		self.req = req
-		self.__wwwroot = self.req.document_root()
+	"""
+	Routes requests through the pluggables declared in the configuration file.
+
+	A dispatcher is built once per process and per document root: the
+	configuration is parsed and pluggables are loaded at construction time,
+	then reused for every request. The request being served is bound to the
+	current thread with bind() and reached by pluggables through a proxy,
+	keeping routing tables free of per-request state.
+	"""
+
+	def __init__(self, wwwroot, config_file='config.xml'):
+		self.__wwwroot = wwwroot
+		self.__context = local()
+		self.req = ThreadProxy(self.__context, 'request')
 		self.vhosts = {}
+		self.routes = {}
 		self.error_handlers = {}
+		self.compressors = {}
 		self.__read_config(os.path.join(self.__wwwroot,config_file))
 		self.__load_pluggables()
+
+	def bind(self, req):
+		"""
+		Bind a request to the current thread
+		"""
+		self.__context.request = req
+
+	def release(self):
+		"""
+		Unbind current thread's request
+		"""
+		if hasattr(self.__context, 'request'):
+			del self.__context.request
 	
 	def __read_config(self, cfg_file):
 		"""
 		Load configuration file (generally 'config.xml' at web server's document root
 		"""
-		self.settings = SettingsLoader(cfg_file).read()
+		self.settings = SettingsLoader.load(cfg_file)
 	
 	def __load_pluggables(self):
 		"""
@@ -47,14 +77,18 @@ class ApwalDispatcher:
 		for vhost_name in vhosts:
 			# for each vhost, load every pluggable defined in configuration
 			self.vhosts[vhost_name] = []
+			self.routes[vhost_name] = RouteTrie()
 			self.error_handlers[vhost_name] = {}
+			options = self.settings.getCompression(vhost_name)
+			if options is not None:
+				self.compressors[vhost_name] = Compressor(**options)
 			for plug in vhosts[vhost_name]:
 				# for every plug, try to load it
 				try:
 					try:
-						# try to load plug from web root
-						a,b,c=find_module(plug['src'],[self.__wwwroot])
-						x=load_module(plug['src'],a,b,c)
+						# try to load plug from web root (once per process,
+						# for every plug and vhost using it)
+						x=module_cache.load(plug['src'],[self.__wwwroot])
 					except ImportError,e:
 						# if not found, try to load from python defined tools
 						# this feature can be useful to load predefined tools
@@ -68,6 +102,10 @@ class ApwalDispatcher:
 								for err_code,method in z.getErrorHandlers():
 									self.error_handlers[vhost_name][err_code]=method
 								self.vhosts[vhost_name].append(z)
+								for url,method in z.getBoundMethods():
+									self.routes[vhost_name].add(url,method)
+								# routes hot plugged afterwards
+								z.addRouteListener(self.routes[vhost_name].add)
 							except TypeError,e:
 								raise DebugMsg(plug['src']+'::'+attr+"->%s"%e)
 				except ImportError,e:
@@ -75,6 +113,8 @@ class ApwalDispatcher:
 					raise DebugMsg('import error: %s'%e)
 					# TODO: gestion des erreurs
 					pass
+			# compile every route of this vhost into a single route trie
+			self.routes[vhost_name].compile()
 
 					
 	def route(self, uri=None):
@@ -84,13 +124,22 @@ class ApwalDispatcher:
 		vhost = self.req.hostname
 		if uri is None:
 			uri = self.req.uri
-		if vhost in self.vhosts:
-			for plug in self.vhosts[vhost]:
-				status,response = plug.findRoute(uri)
-				if status:
-					return response
+		if vhost in self.routes:
+			status,response = self.routes[vhost].dispatch(uri)
+			if status:
+				return response
 			return None
 
+	def compress(self, response):
+		"""
+		Compress a response if enabled for the current vhost, returns the
+		response to send
+		"""
+		vhost = self.req.hostname
+		if vhost in self.compressors:
+			return self.compressors[vhost].compress(self.req, response)
+		return response
+
 	def hasErrorHandler(self, error_code):
 		"""
 		Check if registered pluggables have defined an error handler for the
@@ -112,12 +161,78 @@ class ApwalDispatcher:
 				return self.error_handlers[vhost][error_code]()
 		return None
 		
+class DispatcherCache(object):
+
+	"""
+	Dispatchers by document root, built on first use and built again when
+	their configuration file changes. The file is checked at most every
+	Settings.globals.config_check_interval seconds (None disables checks).
+
+	A new dispatcher replaces the former one at once: requests in progress
+	finish with the dispatcher they started with. If the new configuration
+	cannot be loaded, the former dispatcher is kept. While a thread checks
+	or rebuilds a dispatcher, other threads keep using the former one
+	instead of waiting.
+	"""
+
+	def __init__(self, config_file='config.xml'):
+		self.__config = config_file
+		# wwwroot => (dispatcher, config stamp, last check time)
+		self.__entries = {}
+		self.__lock = Lock()
+
+	def __is_fresh(self, entry, now):
+		interval = Settings.globals.config_check_interval
+		return interval is None or now - entry[2] < interval
+
+	def get(self, wwwroot):
+		"""
+		Return the current dispatcher of a document root
+		"""
+		entry = self.__entries.get(wwwroot)
+		if entry is not None:
+			if self.__is_fresh(entry, time.time()):
+				return entry[0]
+			if not self.__lock.acquire(False):
+				# being checked by another thread
+				return entry[0]
+		else:
+			self.__lock.acquire()
+		try:
+			# another thread may have done the check meanwhile
+			entry = self.__entries.get(wwwroot)
+			now = time.time()
+			if entry is not None and self.__is_fresh(entry, now):
+				return entry[0]
+			stamp = config_stamp(os.path.join(wwwroot, self.__config))
+			if entry is None:
+				dispatcher = ApwalDispatcher(wwwroot, config_file=self.__config)
+			elif entry[1] == stamp:
+				dispatcher = entry[0]
+			else:
+				try:
+					dispatcher = ApwalDispatcher(wwwroot, config_file=self.__config)
+				except Exception:
+					# keep serving with the former configuration
+					traceback.print_exc()
+					dispatcher = entry[0]
+			self.__entries[wwwroot] = (dispatcher, stamp, now)
+			return dispatcher
+		finally:
+			self.__lock.release()
+
+_dispatchers = DispatcherCache()
+
 def handler(req):
 	"""
 	Apache's mod_python handler
 	"""
-	_handler = PywaDispatcher(req)
-	response = _handler.route()
+	_handler = _dispatchers.get(req.document_root())
+	_handler.bind(req)
+	try:
+		response = _handler.route()
+	finally:
+		_handler.release()
 	if response:
 		req.status = 200
 		req.content_type = 'text/html'
@@ -128,45 +243,121 @@ def handler(req):
 		req.write('server error')
 		return apache.OK
 
+class ClosingIterator(object):
+
+	"""
+	WSGI iterable wrapping a response body, running callbacks once the
+	server closes it
+	"""
+
+	def __init__(self, iterable, *callbacks):
+		self.__iterable = iterable
+		self.__callbacks = callbacks
+
+	def __iter__(self):
+		return iter(self.__iterable)
+
+	def close(self):
+		try:
+			if hasattr(self.__iterable, 'close'):
+				self.__iterable.close()
+		finally:
+			for callback in self.__callbacks:
+				callback()
+
 class WSGIHandler(object):
 
-	def __init__(self, configFile=None):
-		self.__config = configFile
-	
 	"""
 	Apache mod_wsgi dedicated handler
+
+	Dispatchers are cached (one per document root, see DispatcherCache), so
+	configuration parsing and pluggables loading only happen on the first
+	request and when the configuration file changes.
 	"""
+
+	def __init__(self, configFile=None):
+		if configFile:
+			self.__config = configFile
+		else:
+			self.__config = 'config.xml'
+		self.__dispatchers = DispatcherCache(self.__config)
+
+	def get_dispatcher(self, wwwroot):
+		"""
+		Return the current dispatcher associated with a document root
+		"""
+		return self.__dispatchers.get(wwwroot)
+
 	def __call__(self, environ, start_response):
+		request = WSGIRequest(environ)
+		dispatcher = self.get_dispatcher(request.document_root())
+		dispatcher.bind(request)
 		try:
-			self._handler = ApwalDispatcher(WSGIRequest(environ),config_file=self.__config)
-			response = self._handler.route()
+			body = self.__dispatch(dispatcher, environ, start_response)
+		except:
+			dispatcher.release()
+			raise
+		if isinstance(body, HttpResponse) and not isinstance(body, HttpFileResponse):
+			# streamed bodies may still use the request while being iterated
+			return ClosingIterator(body, dispatcher.release)
+		dispatcher.release()
+		return body
+
+	def __respond(self, dispatcher, environ, response, start_response, reason):
+		"""
+		Send response status and headers, and return the response itself as
+		the WSGI iterable, so that iterable contents are streamed chunk by
+		chunk. File responses are handed to the server's file wrapper if
+		available and if the whole file is sent.
+		"""
+		response = dispatcher.compress(response)
+		# 1xx, 204 and 304 responses must not carry a Content-Length
+		if response._is_string and not response.has_header('Content-Length') \
+				and response.status_code >= 200 and response.status_code not in (204, 304):
+			response['Content-Length'] = str(len(response.content))
+		start_response(str(response.status_code)+' '+reason, response.headers.items())
+		if isinstance(response, HttpFileResponse):
+			if 'wsgi.file_wrapper' in environ and not response.ranges:
+				return environ['wsgi.file_wrapper'](response.filelike, response.block_size)
+		return response
+
+	def __dispatch(self, dispatcher, environ, start_response):
+		try:
+			# reject oversized bodies before reading them
+			max_body_size = Settings.globals.max_body_size
+			if max_body_size is not None and dispatcher.req.content_length > max_body_size:
+				raise RequestEntityTooLarge()
+			response = dispatcher.route()
 			if response:
-				start_response(str(response.status_code)+' WSGI-GENERATED', response.headers.items())
-				return [response.content]
+				return self.__respond(dispatcher, environ, response, start_response, 'WSGI-GENERATED')
 			else:
-				if self._handler.hasErrorHandler(404):
-					response = self._handler.route_error(404)
-					start_response(str(response.status_code)+' NOT FOUND', response.headers.items())
-					return [response.content]
+				if dispatcher.hasErrorHandler(404):
+					response = dispatcher.route_error(404)
+					return self.__respond(dispatcher, environ, response, start_response, 'NOT FOUND')
 				else:
 					raise FileNotFound()
 		except FileNotFound,e:
-				if self._handler.hasErrorHandler(404):
-					response = self._handler.route_error(404)
-					start_response(str(response.status_code)+' NOT FOUND', response.headers.items())
-					return [response.content]
+				if dispatcher.hasErrorHandler(404):
+					response = dispatcher.route_error(404)
+					return self.__respond(dispatcher, environ, response, start_response, 'NOT FOUND')
 				else:
 					start_response("404 NOT FOUND",[('Content-Type','text/plain')])
 					return ['Object not found']	
+		except RequestEntityTooLarge,e:
+				if dispatcher.hasErrorHandler(413):
+					response = dispatcher.route_error(413)
+					return self.__respond(dispatcher, environ, response, start_response, 'REQUEST ENTITY TOO LARGE')
+				else:
+					start_response("413 REQUEST ENTITY TOO LARGE",[('Content-Type','text/plain')])
+					return ['Request entity too large']
 		except InternalRedirect,e:
-			return self._handler.route(e.getDestination())
+			return dispatcher.route(e.getDestination())
 		except ExternalRedirect,e:
 			return HttpResponseRedirect(e.getDestination())
 		except Exception,e:
-			if self._handler.hasErrorHandler(500):
-				response = self._handler.route_error(500)
-				start_response(str(response.status_code)+' SERVER ERROR', response.headers.items())
-				return [response.content]
+			if dispatcher.hasErrorHandler(500):
+				response = dispatcher.route_error(500)
+				return self.__respond(dispatcher, environ, response, start_response, 'SERVER ERROR')
 			else:
 				start_response("500 SERVER ERROR",[('Content-Type','text/plain')])
 				return ['Internal server error: %s'%(e)]
@@ -1,5 +1,6 @@
 import re
 from apwal.core.utils import DebugMsg
+from apwal.core.router import RouteTable
 
 __all__ = [
     'Pluggable',
@@ -37,7 +38,11 @@ class Pluggable:
         self.__pluggables = []
         self.__methods = []
         self.__error_handlers = []
+        self.__route_listeners = []
         self.__map_methods()
+        # compiled on first lookup only: the dispatcher routes requests
+        # through its own table
+        self.__routes = RouteTable(self.__methods)
         self.__load_pluggables()
 
     def __load_pluggables(self):
@@ -88,11 +93,24 @@ class Pluggable:
         """
         Hot plug any pluggable
         """
-        # map pluggable bound methods into our module
+        # map pluggable bound methods into our module (the route table is
+        # compiled again on next lookup)
         for route,method in pluggable.getBoundMethods():
             #print '-> %s' % (self.__url+'/'+self.__trim_url(url))
-            self.__methods.append((self.route+'/'+self.__trim_url(route),method))
-        
+            url = self.route+'/'+self.__trim_url(route)
+            self.__methods.append((url,method))
+            self.__routes.add(url,method)
+            for listener in self.__route_listeners:
+                listener(url,method)
+
+    def addRouteListener(self, listener):
+        """
+        Register a callable called with (url, method) for every route added
+        later on by plug(), so that the dispatcher routing requests through
+        its own table sees them
+        """
+        self.__route_listeners.append(listener)
+
     def __map_methods(self):
         """
         Scan methods and list all bindable methods with their associated
@@ -119,18 +137,7 @@ class Pluggable:
 
         @return    True if a route was found, False otherwise
         """
-        urls = ''
-        for url,method in self.__methods:
-            urls = urls+';'+url
-            res = re.match('^%s$'%url,requestedUrl)
-            if res:
-                if len(res.groupdict())>0:
-                    response = method(res.groupdict())
-                else:
-                    response = method()
-                return True,response
-        
-        return False,None
+        return self.__routes.dispatch(requestedUrl)
 
 
 class onerror:
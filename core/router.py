@@ -0,0 +1,301 @@
+import re
+
+__all__ = [
+    'RouteTable',
+    'RouteTrie',
+]
+
+# python's sre engine cannot handle more than 100 groups in a single regexp
+MAX_GROUPS = 100
+
+# characters ending the static part of an url regexp
+REGEX_CHARS = '.^$*+?{}[]\\|()'
+
+class Router(object):
+
+    """
+    Router template: children implement resolve()
+    """
+
+    def resolve(self, requestedUrl):
+        raise NotImplementedError()
+
+    def dispatch(self, requestedUrl):
+        """
+        Calls the method bound to a given url, with extra parameters if any.
+
+        @return    (True, response) if a route was found, (False, None) otherwise
+        """
+        found = self.resolve(requestedUrl)
+        if found:
+            method, urlparams = found
+            if urlparams is not None:
+                return True, method(urlparams)
+            return True, method()
+        return False, None
+
+
+class RouteTable(Router):
+
+    """
+    Compiled route table.
+
+    Routes (url regexps as built by Pluggable) are compiled once into a small
+    set of combined alternations. Each route is wrapped into its own group,
+    and its named groups are renamed in order to avoid collisions with other
+    routes. Resolving an url then costs one regexp match per chunk of routes
+    (a chunk holds up to MAX_GROUPS groups), the index of the last matched
+    group giving the route that matched.
+
+    Routes are tried in the order they were added, as Pluggable.findRoute
+    used to do.
+    """
+
+    def __init__(self, routes=()):
+        self.__routes = []
+        self.__chunks = None
+        for url, method in routes:
+            self.add(url, method)
+
+    def __len__(self):
+        return len(self.__routes)
+
+    def add(self, url, method):
+        """
+        Add a route (regexp without ^ and $) bound to a method
+        """
+        self.__routes.append((url, method))
+        self.__chunks = None
+
+    def getRoutes(self):
+        """
+        Returns declared routes and associated methods
+        """
+        return self.__routes
+
+    def __rename_groups(self, url, prefix):
+        """
+        Prefix every named group (and named backreference) of an url regexp
+        """
+        url = re.sub(r'\(\?P<([^>]+)>', r'(?P<%s\1>' % prefix, url)
+        return re.sub(r'\(\?P=([^)]+)\)', r'(?P=%s\1)' % prefix, url)
+
+    def __compile_chunk(self, routes):
+        """
+        Compile a set of (index, url, method, names) routes into a single
+        alternation. Returns a list of (pattern, handlers) tuples, handlers
+        mapping a group index to a (index, method, params) tuple where params
+        maps each pattern group name to its url parameter name.
+        """
+        parts = []
+        handlers = {}
+        group = 1
+        for index, url, method, names in routes:
+            prefix = '_r%d_' % index
+            parts.append('(%s)' % self.__rename_groups(url, prefix))
+            handlers[group] = (index, method, [(prefix+name, name) for name in names])
+            group += 1 + re.compile(url).groups
+        try:
+            pattern = re.compile('^(?:%s)$' % '|'.join(parts))
+            return [(pattern, handlers)]
+        except (re.error, AssertionError):
+            return [self.__compile_route(route) for route in routes]
+
+    def __compile_route(self, route):
+        """
+        Compile a single route on its own, for regexps that cannot be
+        combined (numbered backreferences for instance)
+        """
+        index, url, method, names = route
+        return (re.compile('^%s$' % url), {None: (index, method, [(name, name) for name in names])})
+
+    def compile(self):
+        """
+        Compile routes into combined regexps
+        """
+        chunks = []
+        chunk = []
+        groups = 0
+        for index, (url, method) in enumerate(self.__routes):
+            route_re = re.compile('^%s$' % url)
+            names = route_re.groupindex.keys()
+            if re.search(r'\\[1-9]', url):
+                # numbered backreferences would be shifted once combined
+                if chunk:
+                    chunks.extend(self.__compile_chunk(chunk))
+                    chunk = []
+                    groups = 0
+                chunks.append(self.__compile_route((index, url, method, names)))
+                continue
+            if chunk and groups + route_re.groups + 1 > MAX_GROUPS:
+                chunks.extend(self.__compile_chunk(chunk))
+                chunk = []
+                groups = 0
+            chunk.append((index, url, method, names))
+            groups += route_re.groups + 1
+        if chunk:
+            chunks.extend(self.__compile_chunk(chunk))
+        self.__chunks = chunks
+
+    def match(self, requestedUrl):
+        """
+        Look for the first route matching a given url.
+
+        @return    (index, method, urlparams) if found, None otherwise, index
+                   being the position of the route in the table.
+        """
+        chunks = self.__chunks
+        if chunks is None:
+            self.compile()
+            chunks = self.__chunks
+        for pattern, handlers in chunks:
+            res = pattern.match(requestedUrl)
+            if res:
+                if None in handlers:
+                    index, method, params = handlers[None]
+                else:
+                    index, method, params = handlers[res.lastindex]
+                if params:
+                    return index, method, dict([(name, res.group(group)) for group, name in params])
+                return index, method, None
+        return None
+
+    def resolve(self, requestedUrl):
+        """
+        Look for the route matching a given url.
+
+        @return    (method, urlparams) if found, None otherwise. urlparams is
+                   None if the route does not declare any dynamic parameter.
+        """
+        found = self.match(requestedUrl)
+        if found:
+            return found[1:]
+        return None
+
+
+class RouteNode(object):
+
+    """
+    RouteTrie node: one per static url segment
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.static = None
+        self.dynamic = None
+        self.indexes = []
+
+
+class RouteTrie(Router):
+
+    """
+    Segment trie router.
+
+    The static part of each route (its leading segments free of any regexp
+    special character) is stored in a trie keyed by url segment, the dynamic
+    remainder being compiled into a RouteTable held by the node where the
+    static part ends. Resolving an url walks the trie segment by segment
+    with dict lookups, and only runs regexps at visited nodes owning dynamic
+    routes: lookup cost depends on the url depth, not on the total number of
+    routes.
+
+    As with RouteTable, the first declared route matching an url wins.
+    """
+
+    def __init__(self, routes=()):
+        self.__root = RouteNode()
+        self.__routes = []
+        for url, method in routes:
+            self.add(url, method)
+
+    def __len__(self):
+        return len(self.__routes)
+
+    def __split(self, url):
+        """
+        Split an url regexp into its static prefix (complete segments only)
+        and its dynamic remainder
+        """
+        for pos, char in enumerate(url):
+            if char in REGEX_CHARS:
+                cut = url.rfind('/', 0, pos)
+                if cut < 0:
+                    return '', url
+                return url[:cut], url[cut:]
+        return url, None
+
+    def __node(self, prefix, create=False):
+        node = self.__root
+        for segment in prefix.split('/'):
+            if segment not in node.children:
+                if not create:
+                    return None
+                node.children[segment] = RouteNode()
+            node = node.children[segment]
+        return node
+
+    def add(self, url, method):
+        """
+        Add a route (regexp without ^ and $) bound to a method
+        """
+        index = len(self.__routes)
+        self.__routes.append((url, method))
+        prefix, dynamic = self.__split(url)
+        node = self.__node(prefix, create=True)
+        if dynamic is None:
+            # keep the first declared route, as it would be matched first
+            if node.static is None:
+                node.static = (index, method)
+        else:
+            if node.dynamic is None:
+                node.dynamic = RouteTable()
+            node.dynamic.add(dynamic, method)
+            node.indexes.append(index)
+
+    def getRoutes(self):
+        """
+        Returns declared routes and associated methods
+        """
+        return self.__routes
+
+    def compile(self):
+        """
+        Compile dynamic routes of every node
+        """
+        nodes = [self.__root]
+        while nodes:
+            node = nodes.pop()
+            if node.dynamic is not None:
+                node.dynamic.compile()
+            nodes.extend(node.children.values())
+
+    def resolve(self, requestedUrl):
+        """
+        Look for the route matching a given url.
+
+        @return    (method, urlparams) if found, None otherwise. urlparams is
+                   None if the route does not declare any dynamic parameter.
+        """
+        best = None
+        node = self.__root
+        consumed = -1
+        for segment in requestedUrl.split('/'):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            consumed += len(segment) + 1
+            if node.dynamic is not None:
+                found = node.dynamic.match(requestedUrl[consumed:])
+                if found:
+                    index, method, urlparams = found
+                    index = node.indexes[index]
+                    if best is None or index < best[0]:
+                        best = (index, method, urlparams)
+        else:
+            # whole url consumed: static routes match exactly
+            if node.static is not None:
+                if best is None or node.static[0] < best[0]:
+                    best = node.static + (None,)
+        if best:
+            return best[1:]
+        return None
@@ -1,4 +1,8 @@
-import os, time, datetime, random, base64, uuid, re
+import os, time, datetime, random, base64, uuid, re, errno, tempfile
+import sqlite3, marshal, zlib, json, mmap, struct
+from hashlib import md5
+from threading import Lock, local
+from collections import OrderedDict
 from apwal.core.utils import ThreadDict
 from apwal.core.settings import Settings
 
@@ -9,6 +13,14 @@ try:
 except ImportError:
     import pickle
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SESSION_ID = re.compile('^[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}$')
+SHARD_ID = re.compile('^[a-f0-9]{2}$')
+
 class SessionExpired(Exception):
 	def __init__(self, session):
 		Exception.__init__(self)
@@ -19,27 +31,37 @@ class SessionExpired(Exception):
 class Session:
 	"""
 	Web session
+
+	Sessions track their modifications: saving a session that was loaded
+	and left unchanged does not write it again. Changes made in place to
+	nested values (session['cart'].append(item)) are not detected, and must
+	be flagged with markDirty().
 	"""
+
+	lifetime = 24*3600*1000
+
 	def __init__(self,store=None, session_uuid=None):
 		if session_uuid:
 			self.uuid = session_uuid
 		else:
 			self.uuid = uuid.uuid1()
-		self.timeout = int(time.time())+24*3600*1000
+		self.timeout = int(time.time())+self.lifetime
 		self.content = {}
+		self.modified = True
 		if store:
 			self.store = store
 		else:
 			self.store = Settings.globals.sessions_store()
 		
 	def toArray(self):
-		return {'uuid':self.uuid,'timeout':self.timeout,'content':self.content}
+		return {'uuid':str(self.uuid),'timeout':self.timeout,'content':self.content}
 	
 	@staticmethod
 	def fromArray(array, store):
 		session = Session(store, array['uuid'])
 		session.timeout = array['timeout']
 		session.content = array['content']
+		session.modified = False
 		return session
 	
 	@staticmethod
@@ -55,16 +77,97 @@ class Session:
 		
 	def __setitem__(self, key, value):
 		self.content[key] = value
+		self.modified = True
+
+	def __delitem__(self, key):
+		del self.content[key]
+		self.modified = True
 		
 	def __len__(self):
 		return len(self.content)
+
+	def markDirty(self):
+		"""
+		Flag session as modified, for changes made in place to its values
+		"""
+		self.modified = True
 		
 	def isExpired(self):
 		return self.timeout<=int(time.time())
 		
-	def save(self):
-		self.store.save(self)
+	def save(self, renew=False):
+		"""
+		Save session if modified. If renew is set, session expiry is pushed
+		back by its lifetime, an unmodified session only having its expiry
+		updated in the store.
+		"""
+		if renew:
+			self.timeout = int(time.time())+self.lifetime
+		if self.modified:
+			self.store.save(self)
+			self.modified = False
+		elif renew:
+			self.store.touch(self)
+
+
+class PickleSerializer(object):
+	"""
+	Session serializer: binary pickle (highest protocol by default)
+	"""
+	def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+		self.protocol = protocol
+
+	def dumps(self, array):
+		return pickle.dumps(array, self.protocol)
+
+	def loads(self, data):
+		return pickle.loads(data)
+
+class MarshalSerializer(object):
+	"""
+	Session serializer: marshal, fast and compact but limited to python
+	builtin types, and bound to the python version
+	"""
+	def dumps(self, array):
+		return marshal.dumps(array)
+
+	def loads(self, data):
+		return marshal.loads(data)
 
+class JSONSerializer(object):
+	"""
+	Session serializer: JSON, limited to plain data (strings are loaded as
+	unicode, tuples as lists)
+	"""
+	def dumps(self, array):
+		return json.dumps(array, separators=(',',':'))
+
+	def loads(self, data):
+		return json.loads(data)
+
+class CompressedSerializer(object):
+	"""
+	Compresses (zlib) payloads of another serializer above a size threshold.
+	A leading byte tells whether a payload is compressed or not.
+	"""
+	def __init__(self, serializer=None, threshold=1024, level=6):
+		if serializer is not None:
+			self.serializer = serializer
+		else:
+			self.serializer = PickleSerializer()
+		self.threshold = threshold
+		self.level = level
+
+	def dumps(self, array):
+		data = self.serializer.dumps(array)
+		if len(data) >= self.threshold:
+			return '\x01' + zlib.compress(data, self.level)
+		return '\x00' + data
+
+	def loads(self, data):
+		if data[0] == '\x01':
+			return self.serializer.loads(zlib.decompress(data[1:]))
+		return self.serializer.loads(data[1:])
 
 class SessionStoreMustImplement(Exception):
 	def __init__(self, method):
@@ -74,18 +177,63 @@ class SessionStoreMustImplement(Exception):
 	def __str__(self):
 		return self.__repr__()
 
+class SessionStoreFull(Exception):
+	def __init__(self, msg):
+		Exception.__init__(self)
+		self.msg = msg
+	def __repr__(self):
+		return self.msg
+	def __str__(self):
+		return self.msg
+
 class SessionStore(object):
 	"""
 	Session store template
+
+	Stores serialize sessions with their serializer (any object providing
+	dumps() and loads()), and may call _count_load() on each load, to clean
+	up expired sessions every sweep_interval loads.
 	"""
+
+	serializer = PickleSerializer()
+	sweep_interval = 100
+
+	# loads count per storage location, shared by every store using it since
+	# a store is instantiated per session
+	_loads = {}
+	_loads_lock = Lock()
+
 	def __init__(self):
 		return
+
+	def _count_load(self, location):
+		"""
+		Count loads and clean expired sessions every sweep_interval loads
+		"""
+		self._loads_lock.acquire()
+		try:
+			loads = self._loads.get(location, 0) + 1
+			due = loads >= self.sweep_interval
+			if due:
+				loads = 0
+			self._loads[location] = loads
+		finally:
+			self._loads_lock.release()
+		if due:
+			self.cleanup()
 		
 	def cleanup(self):
 		raise SessionStoreMustImplement('cleanup')
 		
 	def save(self, session):
 		raise SessionStoreMustImplement('save')
+
+	def touch(self, session):
+		"""
+		Update a stored session's expiry. Stores able to do it without
+		writing the whole session should override this method.
+		"""
+		self.save(session)
 		
 	def load(self, id):
 		raise SessionStoreMustImplement('load')
@@ -96,55 +244,639 @@ class SessionStore(object):
 class FileSystemStore(SessionStore):
 	"""
 	Default session store
+
+	Each session is serialized into a file named after its uuid, stored in a
+	shard directory named after the first two hex digits of the uuid's md5
+	(256 shards), so loading a session is a direct file access and its
+	expiry is checked from the loaded record only. Sessions are written to
+	a temporary file then renamed, readers never seeing partial writes.
+
+	Expiry is indexed: session files get their expiry timestamp as mtime
+	(authoritative over the serialized one, so that touch() renews a session
+	without rewriting it), and an empty marker file named after the session
+	is created in an 'expiry' sub-directory per expiry_bucket seconds.
+	Cleaning up only lists the buckets already (partially) expired and stats
+	their sessions, never reading non expired ones. It runs every
+	sweep_interval loads.
+
+	Sessions stored by previous versions directly in the root directory are
+	moved to their shard when loaded, or all at once by migrate().
 	"""
+
+	expiry_bucket = 3600
 	
-	def __init__(self, sessions_root=None):
+	def __init__(self, sessions_root=None, serializer=None):
 		if sessions_root:
 			self._root = sessions_root
 		else:
 			self._root = Settings.globals.sessions_root
+		if serializer is not None:
+			self.serializer = serializer
+		self._index = os.path.join(self._root, 'expiry')
 		return
+
+	def _shard(self, uuid):
+		"""
+		Returns the shard directory of a session
+		"""
+		return os.path.join(self._root, md5(uuid).hexdigest()[:2])
+
+	def _session_file(self, uuid):
+		return os.path.join(self._shard(uuid), uuid)
+
+	def __makedirs(self, directory):
+		try:
+			os.makedirs(directory)
+		except OSError,e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	def __index(self, uuid, timeout):
+		"""
+		Add a session to the expiry index
+		"""
+		bucket = os.path.join(self._index, str(int(timeout)//self.expiry_bucket))
+		self.__makedirs(bucket)
+		os.close(os.open(os.path.join(bucket, uuid), os.O_WRONLY|os.O_CREAT, 0600))
+
+	def migrate(self):
+		"""
+		Move sessions stored in the root directory (flat layout) to their
+		shard, and index them. Returns the number of migrated sessions.
+		"""
+		migrated = 0
+		for session in os.listdir(self._root):
+			if SESSION_ID.match(session):
+				self.__migrate(session)
+				migrated += 1
+		return migrated
+
+	def __migrate(self, uuid):
+		self.__makedirs(self._shard(uuid))
+		session_file = self._session_file(uuid)
+		try:
+			os.rename(os.path.join(self._root,uuid), session_file)
+		except OSError:
+			# already migrated by another process
+			return
+		session_handle = open(session_file,'rb')
+		try:
+			timeout = pickle.load(session_handle)['timeout']
+		finally:
+			session_handle.close()
+		os.utime(session_file, (timeout, timeout))
+		self.__index(uuid, timeout)
 		
 	def cleanup(self):
-		# load all sessions and clean expired sessions
-		sessions = os.listdir(self._root)
-		for session in sessions:
-			session_file = os.path.join(self._root,session)
-			if re.match('^[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}$', session):
-				session = Session.fromArray(pickle.load(open(session_file,'r')), self)
-				if session.isExpired():
-					os.remove(session_file)
-		
+		"""
+		Remove expired sessions, walking expired buckets of the index
+		"""
+		now = int(time.time())
+		try:
+			buckets = os.listdir(self._index)
+		except OSError:
+			return
+		for bucket in buckets:
+			if not bucket.isdigit() or int(bucket)*self.expiry_bucket > now:
+				continue
+			bucket_dir = os.path.join(self._index, bucket)
+			try:
+				uuids = os.listdir(bucket_dir)
+			except OSError, e:
+				# bucket removed by a concurrent cleanup
+				if e.errno != errno.ENOENT:
+					raise
+				continue
+			for uuid in uuids:
+				session_file = self._session_file(uuid)
+				try:
+					expired = os.stat(session_file).st_mtime <= now
+				except OSError:
+					# session already removed
+					expired = True
+				if expired:
+					try:
+						os.remove(session_file)
+					except OSError:
+						pass
+				if expired or (int(bucket)+1)*self.expiry_bucket <= now:
+					# marker of an expired session, or of a session whose
+					# expiry moved to a later bucket
+					try:
+						os.remove(os.path.join(bucket_dir, uuid))
+					except OSError, e:
+						if e.errno != errno.ENOENT:
+							raise
+			if (int(bucket)+1)*self.expiry_bucket <= now:
+				try:
+					os.rmdir(bucket_dir)
+				except OSError, e:
+					# already removed, or a session was indexed meanwhile
+					if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+						raise
+
 	def __contains__(self, uuid):
 		"""
 		Check if a session is present or not
 		"""
-		self.cleanup()
-		sessions = os.listdir(self._root)
-		return session_id in sessions
+		return self.load(uuid) is not None
 		
 	def save(self, session):
 		"""
-		Save session
+		Save session (atomically) and index its expiry
 		"""
-		session_file = os.path.join(self._root,str(session.uuid))
-		session_handle = open(session_file,'w')
-		pickle.dump(session.toArray(), session_handle)
-		session_handle.close()
+		uuid = str(session.uuid)
+		shard = self._shard(uuid)
+		self.__makedirs(shard)
+		fd, tmp_file = tempfile.mkstemp(prefix='.', dir=shard)
+		try:
+			session_handle = os.fdopen(fd,'wb')
+			try:
+				session_handle.write(self.serializer.dumps(session.toArray()))
+			finally:
+				session_handle.close()
+			os.utime(tmp_file, (session.timeout, session.timeout))
+			os.rename(tmp_file, self._session_file(uuid))
+		except:
+			os.remove(tmp_file)
+			raise
+		self.__index(uuid, session.timeout)
+
+	def touch(self, session):
+		"""
+		Update session expiry, without rewriting it
+		"""
+		uuid = str(session.uuid)
+		try:
+			os.utime(self._session_file(uuid), (session.timeout, session.timeout))
+		except OSError:
+			self.save(session)
+			return
+		self.__index(uuid, session.timeout)
 		
 	def load(self, uuid):
 		"""
-		Load session
+		Load session, None if missing or expired
 		"""
-		# load all sessions and clean expired sessions
-		self.cleanup()
-		sessions = os.listdir(self._root)
-		if uuid in sessions:
-			session_file = os.path.join(self._root,uuid)
-			session_handle = open(session_file,'r')
-			s = Session.fromArray(pickle.load(session_handle), self)
+		uuid = str(uuid)
+		if not SESSION_ID.match(uuid):
+			return None
+		self._count_load(self._root)
+		session_file = self._session_file(uuid)
+		try:
+			session_handle = open(session_file,'rb')
+		except IOError:
+			# may have been stored with the flat layout
+			if not os.path.isfile(os.path.join(self._root,uuid)):
+				return None
+			self.__migrate(uuid)
+			try:
+				session_handle = open(session_file,'rb')
+			except IOError:
+				return None
+		try:
+			s = Session.fromArray(self.serializer.loads(session_handle.read()), self)
+			s.timeout = int(os.fstat(session_handle.fileno()).st_mtime)
+		finally:
 			session_handle.close()
-			return s
+		if s.isExpired():
+			try:
+				os.remove(session_file)
+			except OSError:
+				pass
+			return None
+		return s
+
+class SQLiteStore(SessionStore):
+	"""
+	SQLite session store
+
+	Sessions are stored in a single table indexed on their expiry timestamp,
+	so cleaning up is a single indexed DELETE (run every sweep_interval
+	loads). The database uses WAL journaling, readers never blocking the
+	writer, and each thread gets its own connection.
+	"""
+
+	# per thread connections: database -> connection
+	_connections = local()
+
+	def __init__(self, database=None, serializer=None):
+		if database:
+			self._database = database
+		else:
+			self._database = os.path.join(Settings.globals.sessions_root, 'sessions.db')
+		if serializer is not None:
+			self.serializer = serializer
+
+	def _connection(self):
+		"""
+		Returns current thread's connection, creating it if needed
+		"""
+		if not hasattr(self._connections, 'databases'):
+			self._connections.databases = {}
+		if self._database not in self._connections.databases:
+			connection = sqlite3.connect(self._database, isolation_level=None)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			connection.execute('CREATE TABLE IF NOT EXISTS sessions (uuid TEXT PRIMARY KEY, timeout INTEGER NOT NULL, data BLOB NOT NULL)')
+			connection.execute('CREATE INDEX IF NOT EXISTS sessions_timeout ON sessions (timeout)')
+			self._connections.databases[self._database] = connection
+		return self._connections.databases[self._database]
+
+	def cleanup(self):
+		"""
+		Remove expired sessions
+		"""
+		self._connection().execute('DELETE FROM sessions WHERE timeout<=?', (int(time.time()),))
+
+	def __contains__(self, uuid):
+		"""
+		Check if a session is present or not
+		"""
+		cursor = self._connection().execute('SELECT 1 FROM sessions WHERE uuid=? AND timeout>?', (str(uuid), int(time.time())))
+		return cursor.fetchone() is not None
+
+	def save(self, session):
+		"""
+		Save session
+		"""
+		self._connection().execute('INSERT OR REPLACE INTO sessions (uuid, timeout, data) VALUES (?,?,?)',
+			(str(session.uuid), session.timeout, sqlite3.Binary(self.serializer.dumps(session.toArray()))))
+
+	def touch(self, session):
+		"""
+		Update session expiry, without rewriting it
+		"""
+		self._connection().execute('UPDATE sessions SET timeout=? WHERE uuid=?', (session.timeout, str(session.uuid)))
+
+	def load(self, uuid):
+		"""
+		Load session, None if missing or expired
+		"""
+		self._count_load(self._database)
+		cursor = self._connection().execute('SELECT data, timeout FROM sessions WHERE uuid=? AND timeout>?', (str(uuid), int(time.time())))
+		row = cursor.fetchone()
+		if row is None:
+			return None
+		session = Session.fromArray(self.serializer.loads(str(row[0])), self)
+		session.timeout = row[1]
+		return session
+
+class SharedMemoryStore(SessionStore):
+	"""
+	Memory-mapped session store, shared by every process of a node.
+
+	Sessions are stored in a file mapped in memory, organized as a hash
+	table of fixed-size slots (open addressing with linear probing). Each
+	slot holds a state byte, the session uuid, its expiry timestamp and its
+	serialized record, which must fit in slot_size bytes (minus the slot
+	header). Reading a session involves no system call besides locking:
+	processes lock the file (shared for reads, exclusive for writes, where
+	fcntl is available), threads of a process a mutex.
+
+	The table geometry (slots, slot_size) is set when the file is created,
+	slots defaulting to Settings.globals.sessions_slots (the 'slots'
+	attribute of <sessions> in config.xml). A session is stored within
+	probes slots of its hash position, in the first empty or expired one.
+	When there is none, the session expiring first among them is evicted.
+	Sessions living as long as Session.lifetime (1000 days) hardly ever
+	expire, so size the table for the number of sessions to keep (slots *
+	slot_size bytes of memory): beyond, the least recently saved or renewed
+	sessions are dropped. Expired slots are freed by cleanup().
+	"""
+
+	MAGIC = 'APWALSS1'
+	HEADER = struct.Struct('<8sII')
+	SLOT = struct.Struct('<B36sqI')
+	EMPTY, USED, DELETED = 0, 1, 2
+	probes = 64
+
+	# per process mappings (keyed by pid too, forked processes needing their
+	# own file descriptor for locks to apply between them):
+	# (path, pid) -> (file, mapping, slots, slot size, lock)
+	_tables = {}
+	_tables_lock = Lock()
+
+	def __init__(self, path=None, slots=None, slot_size=4096, serializer=None):
+		if path:
+			self._path = path
+		else:
+			self._path = os.path.join(Settings.globals.sessions_root, 'sessions.mmap')
+		if slots:
+			self._slots = slots
+		else:
+			self._slots = Settings.globals.sessions_slots
+		self._slot_size = slot_size
+		if serializer is not None:
+			self.serializer = serializer
+
+	def __lock(self, handle, exclusive):
+		if fcntl is not None:
+			if exclusive:
+				fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+			else:
+				fcntl.flock(handle.fileno(), fcntl.LOCK_SH)
+
+	def __unlock(self, handle):
+		if fcntl is not None:
+			fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+	def _table(self):
+		"""
+		Returns this process' mapping of the table, creating the table
+		file if needed
+		"""
+		key = (self._path, os.getpid())
+		try:
+			return self._tables[key]
+		except KeyError:
+			pass
+		self._tables_lock.acquire()
+		try:
+			if key not in self._tables:
+				handle = open(self._path, 'a+b')
+				self.__lock(handle, True)
+				try:
+					handle.seek(0)
+					header = handle.read(self.HEADER.size)
+					if len(header) == self.HEADER.size:
+						magic, slots, slot_size = self.HEADER.unpack(header)
+						if magic != self.MAGIC:
+							raise IOError('%s is not a session table' % self._path)
+					else:
+						slots, slot_size = self._slots, self._slot_size
+						handle.truncate(0)
+						handle.write(self.HEADER.pack(self.MAGIC, slots, slot_size))
+						handle.truncate(self.HEADER.size + slots*slot_size)
+						handle.flush()
+				finally:
+					self.__unlock(handle)
+				mapping = mmap.mmap(handle.fileno(), self.HEADER.size + slots*slot_size)
+				self._tables[key] = (handle, mapping, slots, slot_size, Lock())
+			return self._tables[key]
+		finally:
+			self._tables_lock.release()
+
+	def __find(self, uuid):
+		"""
+		Probe the slots of a session. Returns a (slot, free) tuple: the slot
+		holding the session (or None), and the slot that can receive it:
+		the first empty, deleted or expired one, or else the slot of the
+		session expiring first.
+		"""
+		handle, mapping, slots, slot_size, lock = self._table()
+		now = int(time.time())
+		start = int(md5(uuid).hexdigest()[:8], 16) % slots
+		free = None
+		oldest = None
+		for i in xrange(min(self.probes, slots)):
+			slot = (start+i) % slots
+			state, slot_uuid, timeout, length = self.SLOT.unpack_from(mapping, self.HEADER.size + slot*slot_size)
+			if state == self.EMPTY:
+				if free is None:
+					free = slot
+				return None, free
+			if state == self.USED and slot_uuid == uuid:
+				return slot, free
+			if free is None and (state == self.DELETED or timeout <= now):
+				free = slot
+			if state == self.USED and (oldest is None or timeout < oldest[0]):
+				oldest = (timeout, slot)
+		if free is None and oldest is not None:
+			# table full around this position: evict
+			free = oldest[1]
+		return None, free
+
+	def __read(self, uuid, exclusive, func):
+		"""
+		Call func with the slot offset of a session (None if missing), the
+		table being locked
+		"""
+		handle, mapping, slots, slot_size, lock = self._table()
+		lock.acquire()
+		try:
+			self.__lock(handle, exclusive)
+			try:
+				slot, free = self.__find(uuid)
+				if slot is None:
+					return func(None, None)
+				return func(mapping, self.HEADER.size + slot*slot_size)
+			finally:
+				self.__unlock(handle)
+		finally:
+			lock.release()
+
+	def cleanup(self):
+		"""
+		Free slots of expired sessions
+		"""
+		handle, mapping, slots, slot_size, lock = self._table()
+		now = int(time.time())
+		lock.acquire()
+		try:
+			self.__lock(handle, True)
+			try:
+				for slot in xrange(slots):
+					offset = self.HEADER.size + slot*slot_size
+					state, slot_uuid, timeout, length = self.SLOT.unpack_from(mapping, offset)
+					if state == self.USED and timeout <= now:
+						self.SLOT.pack_into(mapping, offset, self.DELETED, slot_uuid, timeout, 0)
+			finally:
+				self.__unlock(handle)
+		finally:
+			lock.release()
+
+	def __contains__(self, uuid):
+		"""
+		Check if a session is present or not
+		"""
+		return self.load(uuid) is not None
+
+	def save(self, session):
+		"""
+		Save session into its slot
+		"""
+		uuid = str(session.uuid)
+		data = self.serializer.dumps(session.toArray())
+		handle, mapping, slots, slot_size, lock = self._table()
+		if len(data) > slot_size - self.SLOT.size:
+			raise SessionStoreFull('session %s does not fit in a %d bytes slot' % (uuid, slot_size))
+		lock.acquire()
+		try:
+			self.__lock(handle, True)
+			try:
+				slot, free = self.__find(uuid)
+				if slot is None:
+					slot = free
+				if slot is None:
+					raise SessionStoreFull('no free slot for session %s' % uuid)
+				offset = self.HEADER.size + slot*slot_size
+				mapping[offset+self.SLOT.size:offset+self.SLOT.size+len(data)] = data
+				self.SLOT.pack_into(mapping, offset, self.USED, uuid, session.timeout, len(data))
+			finally:
+				self.__unlock(handle)
+		finally:
+			lock.release()
+
+	def touch(self, session):
+		"""
+		Update session expiry, without rewriting it
+		"""
+		def update(mapping, offset):
+			if mapping is None:
+				return False
+			state, slot_uuid, timeout, length = self.SLOT.unpack_from(mapping, offset)
+			self.SLOT.pack_into(mapping, offset, state, slot_uuid, session.timeout, length)
+			return True
+		if not self.__read(str(session.uuid), True, update):
+			self.save(session)
+
+	def load(self, uuid):
+		"""
+		Load session, None if missing or expired
+		"""
+		uuid = str(uuid)
+		def read(mapping, offset):
+			if mapping is None:
+				return None
+			state, slot_uuid, timeout, length = self.SLOT.unpack_from(mapping, offset)
+			if timeout <= int(time.time()):
+				return None
+			return timeout, mapping[offset+self.SLOT.size:offset+self.SLOT.size+length]
+		found = self.__read(uuid, False, read)
+		if found is None:
+			return None
+		session = Session.fromArray(self.serializer.loads(found[1]), self)
+		session.timeout = found[0]
+		return session
+
+class CachedStore(SessionStore):
+	"""
+	Write-through LRU cache over another session store.
+
+	At most size sessions are kept in memory, each of them for ttl seconds
+	at most (or until its timeout if ttl is None). Sessions are cached as
+	serialized by the underlying store's serializer, so that loaded sessions
+	never share values with each other or with the cache: changes made in
+	place and not saved stay out of it, as they stay out of the store. The
+	cache is thread-safe, and counts hits and misses.
+
+	The cache is local to a process: with several processes serving the
+	same sessions, a process may serve a session rewritten by another one
+	for up to ttl seconds. Keep ttl short there, and use ttl=None only with
+	a single process.
+
+	As a store is usually created per session by calling
+	Settings.globals.sessions_store, calling a CachedStore returns itself so
+	that a single instance can be shared:
+
+	Settings.globals['sessions_store'] = CachedStore(FileSystemStore())
+	"""
+
+	def __init__(self, store=None, size=1000, ttl=10):
+		if store is not None:
+			self.store = store
+		else:
+			self.store = FileSystemStore()
+		self.size = size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.__cache = OrderedDict()
+		self.__lock = Lock()
+
+	def __call__(self):
+		return self
+
+	def __expires(self, timeout):
+		if self.ttl:
+			return min(timeout, int(time.time())+self.ttl)
+		return timeout
+
+	def __cache_session(self, session):
+		"""
+		Cache a serialized copy of a session, evicting least recently used
+		sessions
+		"""
+		data = self.store.serializer.dumps(session.toArray())
+		uuid = str(session.uuid)
+		self.__lock.acquire()
+		try:
+			self.__cache.pop(uuid, None)
+			self.__cache[uuid] = (self.__expires(session.timeout), session.timeout, data)
+			while len(self.__cache) > self.size:
+				self.__cache.popitem(last=False)
+		finally:
+			self.__lock.release()
+
+	def cleanup(self):
+		"""
+		Drop expired sessions from cache, and clean up underlying store
+		"""
+		now = int(time.time())
+		self.__lock.acquire()
+		try:
+			for uuid, (expires, timeout, data) in self.__cache.items():
+				if expires <= now:
+					del self.__cache[uuid]
+		finally:
+			self.__lock.release()
+		self.store.cleanup()
+
+	def __contains__(self, uuid):
+		"""
+		Check if a session is present or not
+		"""
+		return self.load(uuid) is not None
+
+	def save(self, session):
+		"""
+		Save session into the underlying store, then cache it
+		"""
+		self.store.save(session)
+		self.__cache_session(session)
+
+	def touch(self, session):
+		"""
+		Update session expiry in the underlying store, then in cache (the
+		cached content is kept, as the store does not rewrite it either)
+		"""
+		self.store.touch(session)
+		uuid = str(session.uuid)
+		self.__lock.acquire()
+		try:
+			cached = self.__cache.get(uuid)
+			if cached is not None:
+				self.__cache[uuid] = (self.__expires(session.timeout), session.timeout, cached[2])
+		finally:
+			self.__lock.release()
+
+	def load(self, uuid):
+		"""
+		Load session from cache, or from the underlying store on a miss
+		"""
+		uuid = str(uuid)
+		self.__lock.acquire()
+		try:
+			cached = self.__cache.pop(uuid, None)
+			if cached is not None and cached[0] > int(time.time()):
+				self.__cache[uuid] = cached
+				self.hits += 1
+			else:
+				cached = None
+				self.misses += 1
+		finally:
+			self.__lock.release()
+		if cached is not None:
+			array = self.store.serializer.loads(cached[2])
+			array['timeout'] = cached[1]
+			return Session.fromArray(array, self)
+		session = self.store.load(uuid)
+		if session is None:
+			return None
+		self.__cache_session(session)
+		session.store = self
+		return session
 
 if __name__=='__main__':
 	# gobal settings
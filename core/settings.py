@@ -1,6 +1,25 @@
-from xml.dom.minidom import parse
+import os
+import marshal
+import tempfile
+try:
+	from xml.etree.cElementTree import iterparse
+except ImportError:
+	from xml.etree.ElementTree import iterparse
 from apwal.core.utils import DebugMsg,DotDict
 
+# bumped whenever the layout of configuration snapshots changes
+SNAPSHOT_VERSION = 1
+
+def config_stamp(cfg_file):
+	"""
+	Identify the version of a configuration file (None if missing)
+	"""
+	try:
+		stat = os.stat(cfg_file)
+	except OSError:
+		return None
+	return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
 class Settings:
 	"""
 	Settings object
@@ -11,12 +30,19 @@ class Settings:
 		'sessions_mod':None,
 		'sessions_root':'/tmp/',
 		'sessions_timeout':24*3600*1000,
+		'sessions_slots':4096,
 		'default_charset':'utf-8',
 		'default_mime':'text/html',
+		'upload_spool_threshold':1024*1024,
+		'max_body_size':None,
+		'max_field_size':2560*1024,
+		'config_check_interval':2,
+		'config_snapshot':False,
 	})
 
 	def __init__(self):
 		self.vhosts = {}
+		self.compression = {}
 		self.session_store = None
 		self.session_cookie = 'pywaid'
 		self.session_ipchange = False
@@ -24,6 +50,9 @@ class Settings:
 	def set_vhost(self, vhost_name, plugs):
 		self.vhosts[vhost_name] = plugs
 		
+	def set_compression(self, vhost_name, options):
+		self.compression[vhost_name] = options
+		
 	def set_session(self, store, ipchange=False, cookiename='pywaid'):
 		self.session_store = store
 		self.session_cookie = cookiename
@@ -41,55 +70,155 @@ class Settings:
 	def getVhosts(self):
 		return self.vhosts
 
+	def getCompression(self, vhost_name):
+		"""
+		Returns compression options of a vhost, None if disabled
+		"""
+		return self.compression.get(vhost_name)
+
 class SettingsLoader:
 	
 	"""
 	Config file loader
 	"""
+
+	# parsed settings by configuration file: path => (stamp, settings)
+	__cache = {}
 	
+	def load(cls, cfg_file):
+		"""
+		Returns the settings of a configuration file, parsed once per process
+		and parsed again only when the file changes
+		"""
+		path = os.path.abspath(cfg_file)
+		stamp = config_stamp(path)
+		cached = cls.__cache.get(path)
+		if cached is not None and cached[0] == stamp:
+			return cached[1]
+		settings = cls(path).read()
+		cls.__cache[path] = (stamp, settings)
+		return settings
+	load = classmethod(load)
+
 	def __init__(self, cfg_file):
 		self.cfg_file = cfg_file
 		self.settings = Settings()
 		
 	def read(self):
 		"""
-		Read configuration file, parse it and load it into a configuration object
+		Read configuration file, parse it and load it into a configuration object.
+
+		The file is parsed incrementally: each vhost is processed and freed
+		as soon as its closing tag is read. If Settings.globals.config_snapshot
+		is set, a compiled snapshot of the configuration is written next to
+		the file (see write_snapshot()), and loaded instead of parsing the
+		file as long as the latter does not change.
 		"""
-		self.__cfg = parse(self.cfg_file)
-		
-		# get session parameters if present
-		sessions = self.__cfg.getElementsByTagName('sessions')
-		if len(sessions)>=1:
-			session = sessions[0]
-			Settings.globals['sessions_mode'] = session.getAttribute('type')
-			Settings.globals['sessions_root'] = session.getAttribute('path')
-			Settings.globals['sessions_timeout'] = session.getAttribute('timeout')
-		
-		# get all the vhosts
-		vhosts = self.__cfg.getElementsByTagName('vhost')
-		for vhost in vhosts:
-			# get vhost config
-			vhost_name = vhost.getAttribute('name')
-			if vhost_name:
-				# get vhost plugs and associated routes
-				vhost_plugs = []
-				vhost_tools = []
-				plugs = vhost.getElementsByTagName('plug')
-				for plug in plugs:
-					plug_src = plug.getAttribute('src')
-					plug_route = plug.getAttribute('route')
-					params = plug.getElementsByTagName('param')
-					plug_params = {}
-					for param in params:
-						param_name = param.getAttribute('name')
-						param_value = param.getAttribute('value')
-						plug_params[param_name] = param_value
-					vhost_plugs.append({'src':plug_src, 'route':plug_route,'params':plug_params})
-				self.settings.set_vhost(vhost_name, vhost_plugs)
-		
+		use_snapshot = Settings.globals.config_snapshot
+		stamp = config_stamp(self.cfg_file)
+		if use_snapshot:
+			array = self.read_snapshot(stamp)
+			if array is not None:
+				self.__load_array(array)
+				return self.settings
+		self.__array = {'sessions':None, 'vhosts':[]}
+		for event, elem in iterparse(self.cfg_file):
+			if elem.tag == 'vhost':
+				self.__read_vhost(elem)
+				elem.clear()
+			elif elem.tag == 'sessions' and self.__array['sessions'] is None:
+				self.__array['sessions'] = dict(elem.items())
+		self.__load_array(self.__array)
+		if use_snapshot:
+			self.write_snapshot(stamp, self.__array)
 		# return current settings		
 		return self.settings
 
+	def __read_vhost(self, vhost):
+		"""
+		Extract plugs and compression options of a vhost element
+		"""
+		# get vhost config
+		vhost_name = vhost.get('name')
+		if vhost_name:
+			# get vhost plugs and associated routes
+			vhost_plugs = []
+			for plug in vhost.getiterator('plug'):
+				plug_params = {}
+				for param in plug.getiterator('param'):
+					plug_params[param.get('name', '')] = param.get('value', '')
+				vhost_plugs.append({'src':plug.get('src', ''), 'route':plug.get('route', ''), 'params':plug_params})
+			# get vhost compression options if enabled
+			compression = vhost.find('.//compression')
+			if compression is not None:
+				options = {}
+				if compression.get('types'):
+					options['types'] = [t.strip().lower() for t in compression.get('types').split(',')]
+				for name in ('min_size', 'level'):
+					if compression.get(name):
+						options[name] = int(compression.get(name))
+				if compression.get('cache_dir'):
+					options['cache_dir'] = compression.get('cache_dir')
+				compression = options
+			self.__array['vhosts'].append((vhost_name, vhost_plugs, compression))
+
+	def __load_array(self, array):
+		"""
+		Load parsed configuration (plain types only) into settings
+		"""
+		session = array['sessions']
+		if session is not None:
+			Settings.globals['sessions_mode'] = session.get('type', '')
+			Settings.globals['sessions_root'] = session.get('path', '')
+			Settings.globals['sessions_timeout'] = session.get('timeout', '')
+			if session.get('slots'):
+				Settings.globals['sessions_slots'] = int(session['slots'])
+		for vhost_name, vhost_plugs, compression in array['vhosts']:
+			self.settings.set_vhost(vhost_name, vhost_plugs)
+			if compression is not None:
+				self.settings.set_compression(vhost_name, compression)
+
+	def snapshot_path(self):
+		return self.cfg_file + '.snapshot'
+
+	def read_snapshot(self, stamp):
+		"""
+		Returns the parsed configuration stored in the snapshot, None if
+		missing, unreadable or outdated
+		"""
+		try:
+			f = open(self.snapshot_path(), 'rb')
+			try:
+				version, snapshot_stamp, array = marshal.load(f)
+			finally:
+				f.close()
+		except (IOError, EOFError, ValueError, TypeError):
+			return None
+		if version != SNAPSHOT_VERSION or snapshot_stamp != stamp:
+			return None
+		return array
+
+	def write_snapshot(self, stamp, array):
+		"""
+		Write a snapshot of the parsed configuration (marshal format),
+		silently giving up if the directory is not writable
+		"""
+		path = self.snapshot_path()
+		try:
+			fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+		except OSError:
+			return
+		try:
+			f = os.fdopen(fd, 'wb')
+			try:
+				marshal.dump((SNAPSHOT_VERSION, stamp, array), f)
+			finally:
+				f.close()
+			os.rename(tmp, path)
+		except (IOError, OSError, ValueError):
+			if os.path.exists(tmp):
+				os.unlink(tmp)
+
 if __name__ == '__main__':
 	settings_loader = SettingsLoader('/var/www/apwal-test/config.xml')
 		
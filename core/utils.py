@@ -1,5 +1,8 @@
-from threading import local
-from imp import find_module,load_module
+import os
+from hashlib import md5
+from threading import local, RLock
+from urllib import unquote_plus, urlencode
+from imp import find_module,load_module,PKG_DIRECTORY
 
 try:
     # The mod_python version is more efficient, so try importing it first.
@@ -10,10 +13,14 @@ except ImportError:
 __all__ = [
 	'ThreadStorage',
 	'ThreadDict',
+	'ThreadProxy',
 	'MultiValueDictKeyError',
 	'MultiValueDict',
 	'QueryDict',
+	'QueryString',
 	'parse_cookie',
+	'ModuleCache',
+	'module_cache',
 	'load_tool',
 ]
 
@@ -68,6 +75,44 @@ class ThreadDict(ThreadStorage):
 	def __contains__(self, key):
 		return key in self
 
+class ThreadProxy(object):
+	"""
+	Proxy forwarding every access to an object bound to the current thread.
+
+	Long-lived objects (such as pluggables) may keep a reference to a proxy
+	while the proxied object (such as the current request) changes on each
+	call.
+	"""
+	def __init__(self, storage, name):
+		object.__setattr__(self, '_storage', storage)
+		object.__setattr__(self, '_name', name)
+
+	def _get_target(self):
+		try:
+			return getattr(self._storage, self._name)
+		except AttributeError:
+			raise AttributeError('no %s bound to current thread' % self._name)
+
+	def __getattr__(self, attr):
+		return getattr(self._get_target(), attr)
+
+	def __setattr__(self, attr, value):
+		setattr(self._get_target(), attr, value)
+
+	def __getitem__(self, key):
+		return self._get_target()[key]
+
+	def __contains__(self, key):
+		return key in self._get_target()
+
+	def __nonzero__(self):
+		return hasattr(self._storage, self._name)
+
+	def __repr__(self):
+		if self:
+			return repr(self._get_target())
+		return '<ThreadProxy: no %s bound>' % self._name
+
 class MultiValueDictKeyError(KeyError):
     pass
 
@@ -112,7 +157,7 @@ class MultiValueDict(dict):
         dict.__setitem__(self, key, [value])
 
     def __copy__(self):
-        return self.__class__(dict.items(self))
+        return self.__class__([(key, list(value)) for key, value in dict.items(self)])
 
     def __deepcopy__(self, memo=None):
         import copy
@@ -155,8 +200,7 @@ class MultiValueDict(dict):
 
     def appendlist(self, key, value):
         "Appends an item to the internal list associated with key"
-        self.setlistdefault(key, [])
-        dict.__setitem__(self, key, self.getlist(key) + [value])
+        self.setlistdefault(key, []).append(value)
 
     def items(self):
         """
@@ -198,12 +242,37 @@ class MultiValueDict(dict):
 
 class QueryDict(MultiValueDict):
     """A specialized MultiValueDict that takes a query string when initialized.
-    This is immutable unless you create a copy of it."""
+    This is immutable unless you create a copy of it.
+
+    The query string is split with plain string operations rather than
+    parse_qsl, and only keys and values containing escapes are unquoted.
+    Everything is stored in the dict itself, so that dict-level access
+    (dict(q), json.dumps(q), ...) sees the whole query:
+
+    >>> q = QueryDict('a=1&b=%20x&a=2')
+    >>> dict(q) == {'a': ['1', '2'], 'b': [' x']}
+    True
+
+    Handlers reading a few keys of a large query string should use a
+    QueryString instead (request.query).
+    """
     def __init__(self, query_string, mutable=False):
         MultiValueDict.__init__(self)
-        self._mutable = True
-        for key, value in parse_qsl((query_string or ''), True): # keep_blank_values=True
-            self.appendlist(key, value)
+        # group values by key in a plain dict, then fill self at once
+        lists = {}
+        for field in (query_string or '').replace(';', '&').split('&'):
+            if not field:
+                continue
+            key, sep, value = field.partition('=')
+            if '%' in key or '+' in key:
+                key = unquote_plus(key)
+            if '%' in value or '+' in value:
+                value = unquote_plus(value)
+            if key in lists:
+                lists[key].append(value)
+            else:
+                lists[key] = [value]
+        dict.update(self, lists)
         self._mutable = mutable
 
     def _assert_mutable(self):
@@ -217,7 +286,7 @@ class QueryDict(MultiValueDict):
     def __copy__(self):
         result = self.__class__('', mutable=True)
         for key, value in dict.items(self):
-            dict.__setitem__(result, key, value)
+            dict.__setitem__(result, key, list(value))
         return result
 
     def __deepcopy__(self, memo={}):
@@ -240,9 +309,9 @@ class QueryDict(MultiValueDict):
         self._assert_mutable()
         MultiValueDict.update(self, other_dict)
 
-    def pop(self, key):
+    def pop(self, key, *args):
         self._assert_mutable()
-        return MultiValueDict.pop(self, key)
+        return MultiValueDict.pop(self, key, *args)
 
     def popitem(self):
         self._assert_mutable()
@@ -266,6 +335,80 @@ class QueryDict(MultiValueDict):
             output.extend([urlencode({k: v}) for v in list_])
         return '&'.join(output)
 
+class QueryString(object):
+    """Read-only, lazily parsed view of a query string.
+
+    The query string is split into undecoded values grouped by key on first
+    access, and the values of a key are only unquoted when this key is read,
+    then cached. Not being a dict, it has no storage that could be reached
+    around the parsing, unlike QueryDict:
+
+    >>> q = QueryString('a=1&b=%20x&a=2')
+    >>> q.get('b'), q.getlist('a'), 'c' in q
+    (' x', ['1', '2'], False)
+    """
+    def __init__(self, query_string):
+        self._query_string = query_string or ''
+        self._pending = None
+        self._values = {}
+
+    def _split(self):
+        """
+        Split the query string into undecoded values grouped by (decoded)
+        key, once. Blank values are kept, as parse_qsl(qs, True) does.
+        """
+        pending = self._pending
+        if pending is None:
+            pending = self._pending = {}
+            for field in self._query_string.replace(';', '&').split('&'):
+                if not field:
+                    continue
+                key, sep, value = field.partition('=')
+                if '%' in key or '+' in key:
+                    key = unquote_plus(key)
+                if key in pending:
+                    pending[key].append(value)
+                else:
+                    pending[key] = [value]
+        return pending
+
+    def getlist(self, key):
+        "Returns the list of values of key, an empty list if missing"
+        values = self._values.get(key)
+        if values is None:
+            pending = self._split().get(key)
+            if pending is None:
+                return []
+            values = self._values[key] = [('%' in v or '+' in v) and unquote_plus(v) or v for v in pending]
+        return list(values)
+
+    def get(self, key, default=None):
+        "Returns the last value of key, or default if missing"
+        values = self.getlist(key)
+        if values:
+            return values[-1]
+        return default
+
+    def __getitem__(self, key):
+        values = self.getlist(key)
+        if not values:
+            raise MultiValueDictKeyError, "Key %r not found in query string" % (key,)
+        return values[-1]
+
+    def __contains__(self, key):
+        return key in self._split()
+
+    has_key = __contains__
+
+    def keys(self):
+        return self._split().keys()
+
+    def __len__(self):
+        return len(self._split())
+
+    def __repr__(self):
+        return '<QueryString: %r>' % self._query_string
+
 class DotDict(object):
 	"""
 	Dict with dottable items (e.g. t.a => t['a']
@@ -310,6 +453,71 @@ class DebugMsg(Exception):
 		return self.msg
 		
 
+class ModuleCache(object):
+	"""
+	Cache of modules loaded with imp.find_module/load_module, keyed by
+	resolved path: a module is executed once per process, whatever the
+	number of plugs using it, and executed again only once its source file
+	is modified.
+
+	Each file is loaded under a module name derived from its path, so that
+	files sharing a name (index.py in two document roots for instance) never
+	overwrite each other's module in sys.modules.
+
+	imports counts modules actually executed, per path in counts, and hits
+	counts loads served from the cache.
+	"""
+	def __init__(self):
+		# resolved path => (mtime, module)
+		self.__modules = {}
+		self.__lock = RLock()
+		self.imports = 0
+		self.hits = 0
+		self.counts = {}
+
+	def __mtime(self, pathname, description):
+		if description[2] == PKG_DIRECTORY:
+			pathname = os.path.join(pathname, '__init__.py')
+		try:
+			return os.stat(pathname).st_mtime
+		except OSError:
+			return None
+
+	def load(self, name, path=None):
+		"""
+		Find and load a module as find_module(name, path) and load_module
+		would, reusing the module previously loaded from the same file
+		"""
+		f, pathname, description = find_module(name, path)
+		try:
+			key = os.path.realpath(pathname)
+			mtime = self.__mtime(key, description)
+			self.__lock.acquire()
+			try:
+				cached = self.__modules.get(key)
+				if cached is not None and cached[0] == mtime:
+					self.hits += 1
+					return cached[1]
+				module = load_module('_apwal_plug_' + md5(key).hexdigest(), f, pathname, description)
+				self.__modules[key] = (mtime, module)
+				self.imports += 1
+				self.counts[key] = self.counts.get(key, 0) + 1
+				return module
+			finally:
+				self.__lock.release()
+		finally:
+			if f:
+				f.close()
+
+	def clear(self):
+		self.__lock.acquire()
+		try:
+			self.__modules.clear()
+		finally:
+			self.__lock.release()
+
+module_cache = ModuleCache()
+
 def load_tool(tool_name):
 	parts = tool_name.split('.')
 	deep = 0
@@ -317,14 +525,11 @@ def load_tool(tool_name):
 	p = None
 	if len(parts)>0:
 		while deep<len(parts):
-			# first try to find the part
-			a,b,c = find_module(parts[deep],p)
-			# if found, load module
-			x = load_module(parts[deep],a,b,c)
+			# first try to find the part, and load it
+			x = module_cache.load(parts[deep],p)
 			deep += 1
 			if deep<len(parts):
 				p = x.__path__
-			print p
 		return x
 	else:
 		raise ImportError()
@@ -1,25 +1,44 @@
 import os
+import re
 import string
 import types
 import base64
+import uuid
+import tempfile
+
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from cgi import parse_header
+from cStringIO import StringIO
 
 from Cookie import SimpleCookie
 from pprint import pformat
 from urllib import urlencode, quote
-from apwal.core.utils import MultiValueDict,parse_cookie,QueryDict
+from apwal.core.utils import MultiValueDict,parse_cookie,QueryDict,QueryString
 from apwal.core.settings import Settings
+from apwal.core.exceptions import RequestEntityTooLarge
 
 __all__ = [
 	'HttpRequest',
 	'HttpResponse',
 	'HttpPlainText',
+	'HttpFileResponse',
+	'parse_range_header',
+	'file_etag',
+	'is_not_modified',
+	'serve_file',
 	'parse_file_upload',
+	'MultiPartParser',
+	'MultiPartParserError',
+	'UploadedFile',
+	'LimitedStream',
 	'HttpResponseRedirect',
 	'HttpResponsePermanentRedirect',
 	'HttpResponseNotModified',
 	'HttpResponseNotFound',
 	'HttpResponseForbidden',
 	'HttpResponseNotAllowed',
+	'HttpResponseRangeNotSatisfiable',
+	'HttpResponseRequestEntityTooLarge',
 	'HttpResponseGone',
 	'HttpResponseNeedAuth',
 	'JSONResponse',
@@ -60,36 +79,244 @@ class HttpRequest(object):
     def is_secure(self):
         return os.environ.get("HTTPS") == "on"
 
-def parse_file_upload(header_dict, post_data):
-    "Returns a tuple of (POST MultiValueDict, FILES MultiValueDict)"
-    import email, email.Message
-    from cgi import parse_header
-    raw_message = '\r\n'.join(['%s:%s' % pair for pair in header_dict.items()])
-    raw_message += '\r\n\r\n' + post_data
-    msg = email.message_from_string(raw_message)
-    POST = MultiValueDict()
-    FILES = MultiValueDict()
-    for submessage in msg.get_payload():
-        if submessage and isinstance(submessage, email.Message.Message):
-            name_dict = parse_header(submessage['Content-Disposition'])[1]
+class MultiPartParserError(Exception):
+    pass
+
+class LimitedStream(object):
+    """
+    Wraps a request input stream, never reading past the body length
+    """
+    chunk_size = 64*1024
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        chunks = []
+        while size > 0:
+            chunk = self._stream.read(size)
+            if not chunk:
+                self.remaining = 0
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.remaining -= len(chunk)
+        return ''.join(chunks)
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self._stream.readline(size)
+        self.remaining -= len(line)
+        return line
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+class UploadedFile(object):
+    """
+    Uploaded file, kept in memory up to a size threshold and spooled to a
+    temporary file beyond.
+
+    Behaves as a file object, and gives access to 'filename',
+    'content-type' and 'content' keys as uploaded files used to be dicts.
+    """
+    def __init__(self, filename, content_type, spool_threshold):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+
+    def __getattr__(self, attr):
+        return getattr(self.file, attr)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def __getitem__(self, key):
+        if key == 'filename':
+            return self.filename
+        elif key == 'content-type':
+            return self.content_type
+        elif key == 'content':
+            position = self.file.tell()
+            self.file.seek(0)
+            content = self.file.read()
+            self.file.seek(position)
+            return content
+        raise KeyError, key
+
+    def keys(self):
+        return ['filename', 'content-type', 'content']
+
+    def has_key(self, key):
+        return key in ('filename', 'content-type', 'content')
+
+    __contains__ = has_key
+
+    def get(self, key, default=None):
+        if self.has_key(key):
+            return self[key]
+        return default
+
+    def __repr__(self):
+        return '<UploadedFile: %s (%s, %d bytes)>' % (self.filename, self.content_type, self.size)
+
+class MultiPartParser(object):
+    """
+    Incremental multipart/form-data parser.
+
+    The body is read from a stream by chunks, never reading more than its
+    length. Fields are collected in a POST MultiValueDict, files are written
+    part by part into UploadedFile objects collected in a FILES
+    MultiValueDict, so memory use does not depend on upload sizes. Fields
+    larger than max_field_size (if not None) raise RequestEntityTooLarge.
+    """
+    chunk_size = 64*1024
+    max_header_size = 64*1024
+
+    def __init__(self, stream, content_type, content_length, spool_threshold=None, max_field_size=None):
+        ctype, params = parse_header(content_type)
+        if not ctype.startswith('multipart/') or not params.get('boundary'):
+            raise MultiPartParserError('Invalid multipart content type: %r' % content_type)
+        if spool_threshold is None:
+            spool_threshold = Settings.globals.upload_spool_threshold
+        self._max_field_size = max_field_size
+        self._stream = stream
+        self._remaining = content_length
+        self._boundary = '--' + params['boundary']
+        self._spool_threshold = spool_threshold
+        self._buffer = ''
+
+    def _read(self):
+        """
+        Read next chunk of body, '' once the whole body was read
+        """
+        if self._remaining <= 0:
+            return ''
+        chunk = self._stream.read(min(self.chunk_size, self._remaining))
+        if chunk:
+            self._remaining -= len(chunk)
+        else:
+            self._remaining = 0
+        return chunk
+
+    def _fill(self, size):
+        """
+        Make sure the buffer holds at least size bytes, if available
+        """
+        while len(self._buffer) < size:
+            chunk = self._read()
+            if not chunk:
+                return False
+            self._buffer += chunk
+        return True
+
+    def _read_until(self, delimiter, write, limit=None):
+        """
+        Pass body data to write() up to a delimiter, which is consumed.
+        Returns False if the body ended before the delimiter was found.
+        """
+        keep = len(delimiter)-1
+        written = 0
+        while True:
+            pos = self._buffer.find(delimiter)
+            if pos >= 0:
+                write(self._buffer[:pos])
+                self._buffer = self._buffer[pos+len(delimiter):]
+                return True
+            # keep what could be the beginning of the delimiter
+            if len(self._buffer) > keep:
+                write(self._buffer[:len(self._buffer)-keep])
+                written += len(self._buffer)-keep
+                self._buffer = self._buffer[len(self._buffer)-keep:]
+                if limit is not None and written > limit:
+                    raise MultiPartParserError('Part headers too large')
+            chunk = self._read()
+            if not chunk:
+                write(self._buffer)
+                self._buffer = ''
+                return False
+            self._buffer += chunk
+
+    def _discard(self, data):
+        pass
+
+    def __field_writer(self, value):
+        """
+        Returns a function collecting field data into a list, enforcing
+        max_field_size
+        """
+        size = [0]
+        def write(data):
+            size[0] += len(data)
+            if self._max_field_size is not None and size[0] > self._max_field_size:
+                raise RequestEntityTooLarge()
+            value.append(data)
+        return write
+
+    def parse(self):
+        """
+        Returns a tuple of (POST MultiValueDict, FILES MultiValueDict)
+        """
+        POST = MultiValueDict()
+        FILES = MultiValueDict()
+        delimiter = '\r\n' + self._boundary
+        # skip preamble
+        if not self._read_until(self._boundary, self._discard):
+            return POST, FILES
+        while self._fill(2) and not self._buffer.startswith('--'):
+            # part headers
+            raw_headers = []
+            if not self._read_until('\r\n\r\n', raw_headers.append, self.max_header_size):
+                break
+            headers = {}
+            for line in ''.join(raw_headers).split('\r\n'):
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            name_dict = parse_header(headers.get('content-disposition', ''))[1]
             # name_dict is something like {'name': 'file', 'filename': 'test.txt'} for file uploads
             # or {'name': 'blah'} for POST fields
             # We assume all uploaded files have a 'filename' set.
             if name_dict.has_key('filename'):
-                assert type([]) != type(submessage.get_payload()), "Nested MIME messages are not supported"
                 if not name_dict['filename'].strip():
-                    continue
-                # IE submits the full path, so trim everything but the basename.
-                # (We can't use os.path.basename because it expects Linux paths.)
-                filename = name_dict['filename'][name_dict['filename'].rfind("\\")+1:]
-                FILES.appendlist(name_dict['name'], {
-                    'filename': filename,
-                    'content-type': (submessage.has_key('Content-Type') and submessage['Content-Type'] or None),
-                    'content': submessage.get_payload(),
-                })
+                    found = self._read_until(delimiter, self._discard)
+                else:
+                    # IE submits the full path, so trim everything but the basename.
+                    # (We can't use os.path.basename because it expects Linux paths.)
+                    filename = name_dict['filename'][name_dict['filename'].rfind("\\")+1:]
+                    upload = UploadedFile(filename, headers.get('content-type'), self._spool_threshold)
+                    found = self._read_until(delimiter, upload.write)
+                    upload.seek(0)
+                    FILES.appendlist(name_dict.get('name'), upload)
             else:
-                POST.appendlist(name_dict['name'], submessage.get_payload())
-    return POST, FILES
+                value = []
+                found = self._read_until(delimiter, self.__field_writer(value))
+                POST.appendlist(name_dict.get('name'), ''.join(value))
+            if not found:
+                break
+        return POST, FILES
+
+def parse_file_upload(header_dict, post_data):
+    "Returns a tuple of (POST MultiValueDict, FILES MultiValueDict)"
+    content_type = ''
+    for key in ('CONTENT_TYPE', 'content-type', 'Content-Type'):
+        if header_dict.has_key(key):
+            content_type = header_dict[key]
+            break
+    return MultiPartParser(StringIO(post_data), content_type, len(post_data)).parse()
 
 class HttpResponse(object):
     "A basic HTTP response, with content and dictionary-accessed headers"
@@ -195,6 +422,173 @@ class HttpPlainText(HttpResponse):
 		HttpResponse.__init__(self, content, 'text/plain')
 		self.status_code = 200
 
+class HttpFileResponse(HttpResponse):
+    """
+    Streams a file by fixed-size chunks instead of loading it in memory.
+
+    If byte ranges (inclusive (start, end) tuples) are given, only these
+    spans are read and a 206 partial response is generated, using a
+    multipart/byteranges body for multiple ranges.
+
+    WSGI servers providing 'wsgi.file_wrapper' are handed the file object
+    itself when the whole file is sent, allowing them to use sendfile().
+    """
+    block_size = 64*1024
+
+    def __init__(self, filelike, mimetype=None, block_size=None, ranges=None):
+        HttpResponse.__init__(self, (), mimetype)
+        if block_size:
+            self.block_size = block_size
+        self.filelike = filelike
+        self.ranges = ranges
+        size = os.fstat(filelike.fileno()).st_size
+        if not ranges:
+            self._container = self.__read_chunks(0, size)
+            self['Content-Length'] = str(size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self._container = self.__read_chunks(start, end-start+1)
+            self['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            self['Content-Length'] = str(end-start+1)
+            self.status_code = 206
+        else:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for start, end in ranges:
+                header = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % \
+                    (boundary, self['Content-Type'], start, end, size)
+                parts.append((header, start, end))
+            trailer = '\r\n--%s--\r\n' % boundary
+            self._container = self.__read_parts(parts, trailer)
+            self['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+            self['Content-Length'] = str(sum([len(header)+end-start+1 for header, start, end in parts]) + len(trailer))
+            self.status_code = 206
+        self['Accept-Ranges'] = 'bytes'
+
+    def __read_chunks(self, start, length):
+        self.filelike.seek(start)
+        while length > 0:
+            chunk = self.filelike.read(min(self.block_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def __read_parts(self, parts, trailer):
+        for header, start, end in parts:
+            yield header
+            for chunk in self.__read_chunks(start, end-start+1):
+                yield chunk
+        yield trailer
+
+    def close(self):
+        HttpResponse.close(self)
+        self.filelike.close()
+
+# maximum number of (merged) byte ranges served in a single response
+MAX_RANGES = 16
+
+def parse_range_header(header, size):
+    """
+    Parse a Range header against a file size. Overlapping and adjacent
+    ranges are merged.
+
+    @return    None if the header is missing or invalid, if it asks for more
+               than MAX_RANGES ranges or for the whole file (whole file must
+               be sent), a sorted list of inclusive (start, end) byte ranges
+               otherwise. An empty list means none of the ranges can be
+               satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[6:].split(','):
+        try:
+            start, end = [value.strip() for value in spec.split('-')]
+            if start:
+                start = int(start)
+                if end:
+                    end = int(end)
+                    if end < start:
+                        return None
+                else:
+                    end = size-1
+            else:
+                # suffix range: last bytes of the file
+                start = max(0, size-int(end))
+                end = size-1
+        except ValueError:
+            return None
+        if start < size and end >= start:
+            ranges.append((start, min(end, size-1)))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    if merged and sum([end - start + 1 for start, end in merged]) >= size:
+        return None
+    return merged
+
+def file_etag(stat):
+    """
+    Compute a file entity tag from its inode, size and modification time
+    """
+    return '"%x-%x-%x"' % (stat.st_ino, stat.st_size, int(stat.st_mtime))
+
+# suffix of entity tags of compressed representations (see apwal.http.compression)
+ETAG_ENCODING_SUFFIX = re.compile(r'-(gzip|deflate)"$')
+
+def is_not_modified(request, etag, mtime):
+    """
+    Check conditional headers (If-None-Match takes precedence over
+    If-Modified-Since) against an entity tag and modification time.
+    Tags of compressed representations match their uncompressed entity.
+    """
+    if 'HTTP_IF_NONE_MATCH' in request.META:
+        tags = [tag.strip() for tag in request.META['HTTP_IF_NONE_MATCH'].split(',')]
+        for tag in tags:
+            if tag == '*' or ETAG_ENCODING_SUFFIX.sub('"', tag.replace('W/', '', 1)) == etag:
+                return True
+        return False
+    if 'HTTP_IF_MODIFIED_SINCE' in request.META:
+        since = parsedate_tz(request.META['HTTP_IF_MODIFIED_SINCE'].split(';')[0])
+        if since is not None:
+            return int(mtime) <= mktime_tz(since)
+    return False
+
+def serve_file(request, path, mimetype=None):
+    """
+    Returns a response streaming a file, honouring conditional headers of
+    GET and HEAD requests (validated against the file stat only, without
+    opening it), and Range headers of GET requests
+    """
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    if request.method in ('GET', 'HEAD') and is_not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        # let the compression stage tag the 304 as it would the 200
+        if mimetype:
+            response['Content-Type'] = mimetype
+        response.entity_length = stat.st_size
+    else:
+        ranges = None
+        if request.method == 'GET' and 'HTTP_RANGE' in request.META:
+            if_range = request.META.get('HTTP_IF_RANGE')
+            if not if_range or if_range in (etag, last_modified):
+                ranges = parse_range_header(request.META['HTTP_RANGE'], stat.st_size)
+                if ranges == []:
+                    return HttpResponseRangeNotSatisfiable(stat.st_size)
+        response = HttpFileResponse(open(path, 'rb'), mimetype, ranges=ranges)
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
+
 class HttpResponseRedirect(HttpResponse):
     def __init__(self, redirect_to):
         HttpResponse.__init__(self)
@@ -228,6 +622,17 @@ class HttpResponseNotAllowed(HttpResponse):
         self['Allow'] = ', '.join(permitted_methods)
         self.status_code = 405
 
+class HttpResponseRangeNotSatisfiable(HttpResponse):
+    def __init__(self, size):
+        HttpResponse.__init__(self)
+        self['Content-Range'] = 'bytes */%d' % size
+        self.status_code = 416
+
+class HttpResponseRequestEntityTooLarge(HttpResponse):
+    def __init__(self, *args, **kwargs):
+        HttpResponse.__init__(self, *args, **kwargs)
+        self.status_code = 413
+
 class HttpResponseGone(HttpResponse):
     def __init__(self, *args, **kwargs):
         HttpResponse.__init__(self, *args, **kwargs)
@@ -374,6 +779,11 @@ class ModPythonRequest(HttpRequest):
             self._get = QueryDict(self._req.args)
         return self._get
 
+    def _get_query(self):
+        if not hasattr(self, '_query'):
+            self._query = QueryString(self._req.args)
+        return self._query
+
     def _set_get(self, get):
         self._get = get
 
@@ -437,6 +847,7 @@ class ModPythonRequest(HttpRequest):
         return self.META['REQUEST_METHOD'].upper()
 
     GET = property(_get_get, _set_get)
+    query = property(_get_query)
     POST = property(_get_post, _set_post)
     COOKIES = property(_get_cookies, _set_cookies)
     FILES = property(_get_files)
@@ -490,7 +901,15 @@ class WSGIRequest(HttpRequest):
 
 	def _load_post_and_files(self):
 		if self._env.has_key('CONTENT_TYPE') and self._env['CONTENT_TYPE'].startswith('multipart'):
-			self._post, self._files = parse_file_upload(self._env, self.raw_post_data)
+			if hasattr(self, '_raw_post_data'):
+				stream = StringIO(self._raw_post_data)
+				length = len(self._raw_post_data)
+			else:
+				# parse body while reading it
+				stream = self.stream
+				length = self.stream.remaining
+			self._post, self._files = MultiPartParser(stream, self._env['CONTENT_TYPE'], length,
+				max_field_size=Settings.globals.max_field_size).parse()
 		else:
 			self._post, self._files = QueryDict(self.raw_post_data), MultiValueDict()
 
@@ -504,6 +923,15 @@ class WSGIRequest(HttpRequest):
 			self._get = QueryDict(self._env['QUERY_STRING'])
 		return self._get
 
+	def _get_query(self):
+		"""
+		Lazily parsed query string, cheaper than GET when reading only a few
+		keys of a large query string
+		"""
+		if not hasattr(self, '_query'):
+			self._query = QueryString(self._env['QUERY_STRING'])
+		return self._query
+
 	def _set_get(self, get):
 		self._get = get
 
@@ -557,13 +985,33 @@ class WSGIRequest(HttpRequest):
 			for _header in _headers:
 				if 'HTTP_'+_header in self._env:
 					self._meta['HTTP_'+_header] = self._env['HTTP_'+_header]
+			for key, value in self._env.items():
+				if key.startswith('HTTP_'):
+					self._meta[key] = value
 		return self._meta
 
+	def _get_content_length(self):
+		try:
+			return max(0, int(self._env.get('CONTENT_LENGTH') or 0))
+		except ValueError:
+			return 0
+
+	def _get_stream(self):
+		"""
+		Request body stream, for handlers processing it incrementally
+		"""
+		if not hasattr(self, '_stream'):
+			self._stream = LimitedStream(self._req, self.content_length)
+		return self._stream
+
 	def _get_raw_post_data(self):
 		try:
 			return self._raw_post_data
 		except AttributeError:
-			self._raw_post_data = self._req.read()
+			max_size = Settings.globals.max_field_size
+			if max_size is not None and self.stream.remaining > max_size:
+				raise RequestEntityTooLarge()
+			self._raw_post_data = self.stream.read()
 			return self._raw_post_data
 
 	def _get_uri(self):
@@ -576,12 +1024,15 @@ class WSGIRequest(HttpRequest):
 		return self.META['REQUEST_METHOD'].upper()
 
 	GET = property(_get_get, _set_get)
+	query = property(_get_query)
 	POST = property(_get_post, _set_post)
 	COOKIES = property(_get_cookies, _set_cookies)
 	FILES = property(_get_files)
 	META = property(_get_meta)
 	REQUEST = property(_get_request)
 	raw_post_data = property(_get_raw_post_data)
+	content_length = property(_get_content_length)
+	stream = property(_get_stream)
 	method = property(_get_method)
 	uri = property(_get_uri)
 	hostname = property(_get_hostname)
@@ -0,0 +1,282 @@
+"""
+Response compression stage.
+
+Compression is enabled per vhost in config.xml:
+
+    <vhost name="example.com">
+        <compression types="text/html,application/json" min_size="1024" level="6"
+            cache_dir="/var/cache/apwal"/>
+        ...
+    </vhost>
+
+Every attribute is optional. Responses are compressed with the encoding
+preferred by the client (gzip or deflate) when their MIME type is listed
+and their size reaches min_size. Iterable bodies are compressed chunk by
+chunk as they are sent, and file responses are served from a compressed
+copy cached in the cache directory, rebuilt when the file changes. Without
+cache_dir, a private temporary directory is created for each process.
+"""
+
+import os
+import zlib
+import glob
+import atexit
+import shutil
+import tempfile
+import threading
+from hashlib import md5
+from apwal.http import HttpFileResponse, file_etag
+
+__all__ = [
+    'Compressor',
+    'CompressedStream',
+]
+
+DEFAULT_TYPES = (
+    'text/html',
+    'text/plain',
+    'text/css',
+    'text/xml',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+)
+
+# zlib window bits producing each content-coding
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# server preference when the client accepts both with the same quality
+ENCODINGS = ('gzip', 'deflate')
+
+_private_dir = None
+_private_dir_lock = threading.Lock()
+
+def private_cache_dir():
+    """
+    Returns a temporary directory only accessible to the current user,
+    created once and removed when the process creating it exits (forked
+    workers share it)
+    """
+    global _private_dir
+    _private_dir_lock.acquire()
+    try:
+        if _private_dir is None:
+            _private_dir = tempfile.mkdtemp(prefix='apwal-compressed-')
+            atexit.register(_remove_private_dir, _private_dir, os.getpid())
+        return _private_dir
+    finally:
+        _private_dir_lock.release()
+
+def _remove_private_dir(path, pid):
+    if os.getpid() == pid:
+        shutil.rmtree(path, True)
+
+def parse_accept_encoding(header):
+    """
+    Returns a dict mapping accepted content-codings to their quality
+    """
+    accepted = {}
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, sep, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+class CompressedStream(object):
+    """
+    Iterable compressing the chunks of another iterable as they are read.
+
+    Each chunk is flushed (Z_SYNC_FLUSH) as soon as it is compressed, so
+    that clients receive data at the pace it is produced.
+    """
+
+    def __init__(self, iterable, encoding, level=6, charset='utf-8'):
+        self.__iterable = iterable
+        self.__compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+        self.__charset = charset
+
+    def __iter__(self):
+        for chunk in self.__iterable:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(self.__charset)
+            if chunk:
+                yield self.__compressor.compress(chunk) + self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield self.__compressor.flush()
+
+    def close(self):
+        if hasattr(self.__iterable, 'close'):
+            self.__iterable.close()
+
+
+class Compressor(object):
+    """
+    Compresses responses according to the request's Accept-Encoding header
+    """
+
+    def __init__(self, types=None, min_size=1024, level=6, cache_dir=None):
+        self.types = types and tuple(types) or DEFAULT_TYPES
+        self.min_size = min_size
+        self.level = level
+        if cache_dir is None:
+            cache_dir = private_cache_dir()
+        self.cache_dir = cache_dir
+
+    def negotiate(self, accept_encoding):
+        """
+        Returns the content-coding to use, or None
+        """
+        accepted = parse_accept_encoding(accept_encoding)
+        best = None
+        for encoding in ENCODINGS:
+            quality = accepted.get(encoding, accepted.get('*', 0.0))
+            if quality > 0 and (best is None or quality > best[0]):
+                best = (quality, encoding)
+        return best and best[1] or None
+
+    def is_compressible(self, response):
+        if response.status_code not in (200, 203) or response.has_header('Content-Encoding'):
+            return False
+        if getattr(response, 'ranges', None):
+            return False
+        return self.__has_type(response)
+
+    def __has_type(self, response):
+        mimetype = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        return mimetype in self.types
+
+    def __add_vary(self, response):
+        vary = response.headers.get('Vary')
+        if not vary:
+            response['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            response['Vary'] = vary + ', Accept-Encoding'
+
+    def compress(self, request, response):
+        """
+        Returns the response to send: the given one, compressed if possible
+        """
+        if response.status_code == 304:
+            return self.__not_modified(request, response)
+        if not self.is_compressible(response):
+            return response
+        self.__add_vary(response)
+        encoding = self.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+        if isinstance(response, HttpFileResponse):
+            return self.__compress_file(response, encoding)
+        if response._is_string:
+            content = response.content
+            if len(content) < self.min_size:
+                return response
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+            response.content = compressor.compress(content) + compressor.flush()
+            response['Content-Length'] = str(len(response.content))
+        else:
+            length = response.headers.get('Content-Length')
+            if length is not None and int(length) < self.min_size:
+                return response
+            response._container = CompressedStream(response._container, encoding, self.level, response._charset)
+            del response['Content-Length']
+        self.__set_encoding(response, encoding)
+        return response
+
+    def __not_modified(self, request, response):
+        """
+        Give a 304 response for a file (see serve_file) the Vary header and
+        entity tag of the compressed representation a 200 would have sent
+        """
+        length = getattr(response, 'entity_length', None)
+        if length is None or length < self.min_size or not self.__has_type(response):
+            return response
+        self.__add_vary(response)
+        encoding = self.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        etag = response.headers.get('ETag')
+        if encoding is not None and etag and etag.endswith('"'):
+            response['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+        return response
+
+    def __set_encoding(self, response, encoding):
+        response['Content-Encoding'] = encoding
+        etag = response.headers.get('ETag')
+        if etag and etag.endswith('"'):
+            response['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+
+    def __compress_file(self, response, encoding):
+        """
+        Replace a file response by its cached compressed variant
+        """
+        filelike = response.filelike
+        path = getattr(filelike, 'name', None)
+        if not isinstance(path, basestring) or int(response['Content-Length']) < self.min_size:
+            return response
+        stat = os.fstat(filelike.fileno())
+        cached = self.__cached_variant(filelike, path, stat, encoding)
+        if cached is None:
+            return response
+        compressed = HttpFileResponse(open(cached, 'rb'), response['Content-Type'], response.block_size)
+        for header, value in response.headers.items():
+            if header not in ('Content-Length', 'Content-Type'):
+                compressed[header] = value
+        compressed.status_code = response.status_code
+        response.close()
+        self.__set_encoding(compressed, encoding)
+        return compressed
+
+    def __cached_variant(self, filelike, path, stat, encoding):
+        """
+        Returns the path of the compressed copy of a file, compressing it if
+        missing. Copies are named after the path and entity tag (inode, size
+        and mtime) of their source, older copies being removed on rebuild.
+        """
+        prefix = os.path.join(self.cache_dir, md5(os.path.abspath(path)).hexdigest())
+        cached = '%s.%s.%s' % (prefix, file_etag(stat).strip('"'), encoding)
+        if os.path.exists(cached):
+            return cached
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0700)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        except OSError:
+            return None
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+                filelike.seek(0)
+                while True:
+                    block = filelike.read(HttpFileResponse.block_size)
+                    if not block:
+                        break
+                    out.write(compressor.compress(block))
+                out.write(compressor.flush())
+            finally:
+                out.close()
+            os.rename(tmp, cached)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return None
+        for stale in glob.glob('%s.*.%s' % (prefix, encoding)):
+            if stale != cached:
+                try:
+                    os.unlink(stale)
+                except OSError:
+                    pass
+        return cached
@@ -0,0 +1,232 @@
+"""
+Pre-forking HTTP server.
+
+A master process binds the listening socket and loads the configuration
+and pluggables once (WSGIHandler dispatcher), then forks worker processes
+sharing them copy-on-write. Each worker runs an AsyncServer on the shared
+socket. The master respawns workers that exit, which they do after
+max_requests requests if set (worker recycling).
+
+Signals handled by the master:
+
+    SIGHUP              graceful reload: configuration and pluggables are
+                        reloaded, new workers are started and old ones
+                        finish their requests before exiting
+    SIGTERM, SIGINT     graceful stop
+    SIGTTIN, SIGTTOU    add or remove a worker
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import select
+import traceback
+from apwal.core.handler import WSGIHandler
+from apwal.http.server import AsyncServer
+
+__all__ = [
+    'PreforkServer',
+]
+
+def cpu_count():
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+
+class PreforkServer(object):
+    """
+    Master process managing a pool of AsyncServer worker processes
+    """
+
+    def __init__(self, document_root, host='127.0.0.1', port=8000, workers=None, threads=10,
+                 config_file='config.xml', max_requests=0, keepalive_timeout=15,
+                 graceful_timeout=30, backlog=1024):
+        self.document_root = os.path.abspath(document_root)
+        self.address = (host, port)
+        self.workers = workers or cpu_count()
+        self.threads = threads
+        self.config_file = config_file
+        self.max_requests = max_requests
+        self.keepalive_timeout = keepalive_timeout
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.socket = None
+        self.app = None
+        # pid => generation, for running workers
+        self.__children = {}
+        # pid => deadline, for workers asked to stop
+        self.__stopping = {}
+        self.__generation = 0
+        self.__signals = []
+        self.__running = False
+        self.__crashed = False
+
+    def log(self, msg):
+        sys.stderr.write('[apwal %d] %s\n' % (os.getpid(), msg))
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        self.socket = sock
+        self.address = sock.getsockname()[:2]
+
+    def load(self):
+        """
+        Load configuration and pluggables, before forking
+        """
+        app = WSGIHandler(self.config_file)
+        app.get_dispatcher(self.document_root)
+        self.app = app
+        self.__generation += 1
+
+    def run(self):
+        """
+        Serve until stopped by a signal
+        """
+        if self.socket is None:
+            self.bind()
+        self.load()
+        self.log('listening on http://%s:%d/ with %d workers' % (self.address[0], self.address[1], self.workers))
+        self.__wakeup_r, self.__wakeup_w = os.pipe()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(signum, self.__on_signal)
+        self.__running = True
+        try:
+            while self.__running or self.__children or self.__stopping:
+                self.__handle_signals()
+                self.__reap()
+                if self.__running:
+                    self.__maintain()
+                self.__kill_stragglers()
+                try:
+                    if select.select([self.__wakeup_r], [], [], 1.0)[0]:
+                        os.read(self.__wakeup_r, 4096)
+                except (select.error, OSError), e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        finally:
+            self.socket.close()
+            os.close(self.__wakeup_r)
+            os.close(self.__wakeup_w)
+        self.log('stopped')
+
+    def __on_signal(self, signum, frame):
+        self.__signals.append(signum)
+        try:
+            os.write(self.__wakeup_w, '.')
+        except OSError:
+            pass
+
+    def __handle_signals(self):
+        while self.__signals:
+            signum = self.__signals.pop(0)
+            if signum == signal.SIGHUP:
+                self.reload()
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                self.stop()
+            elif signum == signal.SIGTTIN:
+                self.workers += 1
+            elif signum == signal.SIGTTOU and self.workers > 1:
+                self.workers -= 1
+
+    def reload(self):
+        """
+        Reload configuration and replace every worker
+        """
+        self.log('reloading')
+        try:
+            self.load()
+        except Exception:
+            self.log('reload failed, keeping current workers:\n%s' % traceback.format_exc())
+            return
+        for pid, generation in self.__children.items():
+            if generation < self.__generation:
+                self.__stop_worker(pid)
+
+    def stop(self):
+        self.log('stopping')
+        self.__running = False
+        for pid in self.__children.keys():
+            self.__stop_worker(pid)
+
+    def __stop_worker(self, pid):
+        del self.__children[pid]
+        self.__stopping[pid] = time.time() + self.graceful_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def __kill_stragglers(self):
+        now = time.time()
+        for pid, deadline in self.__stopping.items():
+            if now > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def __reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            if pid in self.__children and status:
+                self.log('worker %d exited with status %d' % (pid, status))
+                # do not respawn failing workers in a tight loop
+                self.__crashed = True
+            self.__children.pop(pid, None)
+            self.__stopping.pop(pid, None)
+
+    def __maintain(self):
+        """
+        Spawn missing workers, stop extra ones
+        """
+        if self.__crashed:
+            self.__crashed = False
+            time.sleep(1)
+        current = [pid for pid, generation in self.__children.items() if generation == self.__generation]
+        for i in range(self.workers - len(current)):
+            self.__spawn()
+        for pid in current[self.workers:]:
+            self.__stop_worker(pid)
+
+    def __spawn(self):
+        pid = os.fork()
+        if pid:
+            self.__children[pid] = self.__generation
+            return
+        # worker process
+        status = 0
+        try:
+            try:
+                for signum in (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+                    signal.signal(signum, signal.SIG_DFL)
+                # the master stops every worker on SIGINT (^C)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                os.close(self.__wakeup_r)
+                os.close(self.__wakeup_w)
+                server = AsyncServer(self.app, sock=self.socket, threads=self.threads,
+                    document_root=self.document_root, keepalive_timeout=self.keepalive_timeout,
+                    max_requests=self.max_requests, environ={'wsgi.multiprocess': True})
+                signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+                server.serve_forever()
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
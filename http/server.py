@@ -0,0 +1,570 @@
+"""
+Event-driven HTTP/1.1 server for WSGI applications.
+
+Connections are multiplexed by a single asyncore loop: reading requests
+and sending responses never ties up a thread, so slow or idle (keep-alive)
+clients cost a socket and a few buffers only. Once a request head and body
+have been received, the application is run in a bounded pool of threads;
+response chunks are handed back to the loop as they are produced, the
+application thread waiting whenever too much output is pending, so
+streamed responses keep bounded memory. Connections whose pending output
+has not moved for send_timeout seconds are closed, releasing the waiting
+thread.
+
+    from apwal.core.handler import WSGIHandler
+    from apwal.http.server import AsyncServer
+
+    AsyncServer(WSGIHandler(), port=8000, document_root='/var/www/apwal').serve_forever()
+"""
+
+import os
+import sys
+import time
+import fcntl
+import errno
+import socket
+import select
+import asyncore
+import threading
+import traceback
+import Queue
+from apwal.core.settings import Settings
+from collections import deque
+from tempfile import SpooledTemporaryFile
+from urllib import unquote
+from email.utils import formatdate
+
+__all__ = [
+    'ThreadPool',
+    'HTTPChannel',
+    'AsyncServer',
+]
+
+SERVER_SOFTWARE = 'Apwal'
+
+# status codes of responses without body
+BODYLESS_STATUS = ('1', '204', '304')
+
+
+class ThreadPool(object):
+    """
+    Fixed-size pool of threads running submitted tasks
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.__tasks = Queue.Queue()
+        self.__threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.__work)
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                break
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def submit(self, func, *args):
+        self.__tasks.put((func, args))
+
+    def stop(self):
+        """
+        Stop threads once pending tasks are done
+        """
+        for thread in self.__threads:
+            self.__tasks.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Wakes the loop up from other threads, running callbacks in the loop
+    thread
+    """
+
+    def __init__(self, map):
+        read, self.__write = os.pipe()
+        fcntl.fcntl(self.__write, fcntl.F_SETFL, fcntl.fcntl(self.__write, fcntl.F_GETFL) | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read, map)
+        os.close(read)
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def pull(self, callback=None):
+        if callback is not None:
+            self.__lock.acquire()
+            try:
+                self.__callbacks.append(callback)
+            finally:
+                self.__lock.release()
+        try:
+            os.write(self.__write, 'x')
+        except OSError, e:
+            # a full pipe already wakes the loop up
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        self.__lock.acquire()
+        try:
+            callbacks, self.__callbacks = self.__callbacks, []
+        finally:
+            self.__lock.release()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.__write)
+
+
+class HTTPChannel(asyncore.dispatcher):
+    """
+    HTTP connection: parses requests, runs them through the server's thread
+    pool one at a time, and sends responses (keep-alive and pipelining
+    supported). Request bodies are received before the application runs,
+    and spooled to disk above spool_threshold bytes. Bodies announced larger
+    than Settings.globals.max_body_size are refused with a 413 as soon as
+    the request head is read.
+    """
+    chunk_size = 64*1024
+    max_header_size = 64*1024
+    spool_threshold = 1024*1024
+    # pending output size above which the application thread waits
+    high_water = 256*1024
+
+    def __init__(self, server, sock, addr):
+        asyncore.dispatcher.__init__(self, sock, server.map)
+        self.server = server
+        self.addr = addr
+        self.last_activity = time.time()
+        # last time output was queued on an empty buffer or sent
+        self.last_progress = self.last_activity
+        self.__input = ''
+        self.__output = deque()
+        self.__output_size = 0
+        self.__cond = threading.Condition()
+        self.__reset()
+
+    def __reset(self):
+        self.__environ = None
+        self.__body = None
+        self.__remaining = 0
+        self.busy = False
+        self.__complete = False
+        self.__keep_alive = False
+
+    # loop thread
+
+    def readable(self):
+        return not self.busy and self.connected
+
+    def writable(self):
+        return bool(self.__output)
+
+    def stalled(self, now, timeout):
+        """
+        True if pending output has not been sent for timeout seconds
+        """
+        return bool(self.__output) and now - self.last_progress > timeout
+
+    def handle_read(self):
+        try:
+            data = self.recv(self.chunk_size)
+        except socket.error:
+            self.close()
+            return
+        if data:
+            self.last_activity = time.time()
+            self.__input += data
+            self.__parse()
+
+    def handle_write(self):
+        self.__cond.acquire()
+        try:
+            data = self.__output[0]
+            sent = self.send(data)
+            if sent < len(data):
+                self.__output[0] = data[sent:]
+            else:
+                self.__output.popleft()
+            self.__output_size -= sent
+            if self.__output_size <= self.high_water:
+                self.__cond.notifyAll()
+            drained = not self.__output
+        finally:
+            self.__cond.release()
+        self.last_activity = self.last_progress = time.time()
+        if drained and self.__complete:
+            self.__next()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        if self.__body is not None:
+            self.__body.close()
+        # wake up an application thread waiting for output to drain
+        self.__cond.acquire()
+        try:
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def __parse(self):
+        """
+        Read the request head then body from the input buffer, and hand the
+        request to the thread pool once complete
+        """
+        if self.__environ is None:
+            self.__input = self.__input.lstrip('\r\n')
+            end = self.__input.find('\r\n\r\n')
+            if end < 0:
+                if len(self.__input) > self.max_header_size:
+                    self.__error('431 Request Header Fields Too Large')
+                return
+            head, self.__input = self.__input[:end], self.__input[end+4:]
+            try:
+                self.__environ = self.__build_environ(head)
+            except ValueError:
+                self.__error('400 Bad Request')
+                return
+            if 'HTTP_TRANSFER_ENCODING' in self.__environ:
+                self.__error('411 Length Required')
+                return
+            self.__remaining = int(self.__environ.get('CONTENT_LENGTH') or 0)
+            max_body_size = Settings.globals.max_body_size
+            if max_body_size is not None and self.__remaining > max_body_size:
+                # refuse before receiving the body (and before 100 Continue)
+                self.__error('413 Request Entity Too Large')
+                return
+            self.__body = SpooledTemporaryFile(self.spool_threshold)
+            if self.__remaining and self.__environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+                self.__push('HTTP/1.1 100 Continue\r\n\r\n')
+        if self.__remaining:
+            data = self.__input[:self.__remaining]
+            self.__input = self.__input[len(data):]
+            self.__body.write(data)
+            self.__remaining -= len(data)
+        if not self.__remaining:
+            self.__body.seek(0)
+            self.__environ['wsgi.input'] = self.__body
+            self.busy = True
+            self.server.pool.submit(self.run, self.__environ)
+
+    def __build_environ(self, head):
+        lines = head.split('\r\n')
+        method, uri, protocol = lines[0].split(' ', 2)
+        if not protocol.startswith('HTTP/'):
+            raise ValueError(protocol)
+        if '://' in uri:
+            # absolute uri: keep its path
+            uri = '/' + uri.split('://', 1)[1].partition('/')[2]
+        path, sep, query = uri.partition('?')
+        environ = self.server.base_environ.copy()
+        environ.update({
+            'REQUEST_METHOD': method.upper(),
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': self.addr and self.addr[0] or '',
+        })
+        name = None
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and name:
+                # obsolete header line folding
+                environ[name] += ' ' + line.strip()
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError(line)
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ and name.startswith('HTTP_'):
+                environ[name] += ',' + value
+            else:
+                environ[name] = value
+        if int(environ.get('CONTENT_LENGTH') or 0) < 0:
+            raise ValueError('negative content length')
+        if 'HTTP_HOST' in environ:
+            environ['SERVER_NAME'] = environ['HTTP_HOST'].rsplit(':', 1)[0]
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if protocol == 'HTTP/1.1':
+            self.__keep_alive = 'close' not in connection
+        else:
+            self.__keep_alive = 'keep-alive' in connection
+        return environ
+
+    def __error(self, status):
+        """
+        Answer a malformed request and close the connection
+        """
+        body = status.split(' ', 1)[1]
+        self.busy = True
+        self.__keep_alive = False
+        self.__push('HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s'
+            % (status, len(body), body))
+        self.__done()
+
+    def __push(self, data):
+        self.__cond.acquire()
+        try:
+            if not self.__output:
+                self.last_progress = time.time()
+            self.__output.append(data)
+            self.__output_size += len(data)
+        finally:
+            self.__cond.release()
+
+    def __done(self):
+        """
+        Called in the loop thread once the whole response has been queued
+        """
+        if not self.connected:
+            return
+        self.__complete = True
+        if not self.__output:
+            self.__next()
+
+    def __next(self):
+        """
+        Response sent: close the connection or wait for the next request
+        """
+        self.server.requests += 1
+        if not self.__keep_alive or self.server.stopping:
+            self.close()
+            return
+        if self.__body is not None:
+            self.__body.close()
+        self.__reset()
+        if self.__input:
+            self.__parse()
+
+    # application thread
+
+    def run(self, environ):
+        """
+        Run the application and queue its response for sending
+        """
+        state = {'sent': False, 'chunked': False}
+        def write(data):
+            if not state['sent']:
+                self.__send_head(environ, state)
+            if data and environ['REQUEST_METHOD'] != 'HEAD':
+                if state['chunked']:
+                    data = '%x\r\n%s\r\n' % (len(data), data)
+                self.__send(data)
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['sent']:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            state['status'] = status
+            state['headers'] = list(headers)
+            return write
+        try:
+            result = self.server.app(environ, start_response)
+            try:
+                for data in result:
+                    write(data)
+                if not state['sent']:
+                    self.__send_head(environ, state)
+                if state['chunked']:
+                    self.__send('0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            if not self.connected:
+                return
+            traceback.print_exc()
+            if state['sent']:
+                # response already started: the client can only be told by a close
+                self.__keep_alive = False
+                self.server.trigger.pull(self.close)
+                return
+            state['status'] = '500 Internal Server Error'
+            state['headers'] = [('Content-Type', 'text/plain'), ('Content-Length', '21')]
+            self.__send_head(environ, state)
+            self.__send('Internal server error')
+        self.server.trigger.pull(self.__done)
+
+    def __send_head(self, environ, state):
+        status = state['status']
+        headers = state['headers']
+        names = [name.lower() for name, value in headers]
+        if 'content-length' not in names and not status.startswith(BODYLESS_STATUS) \
+                and environ['REQUEST_METHOD'] != 'HEAD':
+            if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                state['chunked'] = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                # the end of the body is marked by closing the connection
+                self.__keep_alive = False
+        if self.server.stopping:
+            self.__keep_alive = False
+        if 'date' not in names:
+            headers.append(('Date', formatdate(usegmt=True)))
+        if 'server' not in names:
+            headers.append(('Server', SERVER_SOFTWARE))
+        headers.append(('Connection', self.__keep_alive and 'keep-alive' or 'close'))
+        state['sent'] = True
+        self.__send('HTTP/1.1 %s\r\n%s\r\n\r\n' % (status, '\r\n'.join(['%s: %s' % header for header in headers])))
+
+    def __send(self, data):
+        """
+        Queue data for sending, waiting while too much output is pending
+        """
+        self.__cond.acquire()
+        try:
+            while self.__output_size > self.high_water and self.connected:
+                self.__cond.wait(1.0)
+            if not self.connected:
+                raise IOError('client disconnected')
+            if not self.__output:
+                self.last_progress = time.time()
+            self.__output.append(data)
+            self.__output_size += len(data)
+        finally:
+            self.__cond.release()
+        self.server.trigger.pull()
+
+
+class AsyncServer(asyncore.dispatcher):
+    """
+    Listening server: accepts connections into HTTPChannels, and runs the
+    loop. An already bound socket may be given (to share it between
+    processes). If max_requests is set, the server stops after answering
+    that many requests. Connections not reading their response for
+    send_timeout seconds are closed.
+    """
+
+    def __init__(self, app, host='', port=8000, threads=10, document_root=None,
+                 sock=None, backlog=128, keepalive_timeout=15, environ=None, max_requests=0,
+                 send_timeout=60):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.__own_socket = sock is None
+        if sock is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind((host, port))
+            self.listen(backlog)
+        else:
+            sock.setblocking(0)
+            self.set_socket(sock, self.map)
+            self.accepting = True
+        host, port = self.socket.getsockname()[:2]
+        self.app = app
+        self.keepalive_timeout = keepalive_timeout
+        self.send_timeout = send_timeout
+        self.pool = ThreadPool(threads)
+        self.trigger = Trigger(self.map)
+        self.requests = 0
+        self.max_requests = max_requests
+        self.stopping = False
+        self.__shutdown = False
+        self.base_environ = {
+            'SERVER_NAME': host or socket.gethostname(),
+            'SERVER_PORT': str(port),
+            'SERVER_SOFTWARE': SERVER_SOFTWARE,
+            'SCRIPT_NAME': '',
+            'DOCUMENT_ROOT': document_root or os.getcwd(),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if environ:
+            self.base_environ.update(environ)
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is not None:
+            sock, addr = pair
+            HTTPChannel(self, sock, addr)
+
+    def handle_error(self):
+        traceback.print_exc()
+
+    def channels(self):
+        return [channel for channel in self.map.values() if isinstance(channel, HTTPChannel)]
+
+    def stop(self):
+        """
+        Stop accepting connections: serve_forever() returns once requests
+        being processed are answered
+        """
+        if not self.stopping:
+            self.stopping = True
+            if self.__own_socket:
+                self.close()
+            else:
+                # shared socket: leave it open for other processes
+                self.del_channel()
+                self.accepting = False
+
+    def shutdown(self):
+        """
+        Ask the loop to stop(), safe to call from signal handlers and other
+        threads
+        """
+        self.__shutdown = True
+        self.trigger.pull()
+
+    def serve_forever(self, poll=1.0):
+        last_check = time.time()
+        while not self.stopping or [c for c in self.channels() if c.busy]:
+            # poll() is not limited to FD_SETSIZE descriptors as select() is
+            asyncore.loop(poll, use_poll=hasattr(select, 'poll'), map=self.map, count=1)
+            if self.__shutdown or (self.max_requests and self.requests >= self.max_requests):
+                self.stop()
+            now = time.time()
+            if now - last_check >= poll:
+                last_check = now
+                # close idle connections, and busy ones whose client stopped reading
+                for channel in self.channels():
+                    if not channel.busy and (self.stopping or now - channel.last_activity > self.keepalive_timeout):
+                        channel.close()
+                    elif channel.stalled(now, self.send_timeout):
+                        channel.close()
+        for channel in self.channels():
+            channel.close()
+        self.trigger.close()
+        self.pool.stop()
@@ -2,7 +2,7 @@
 import os,mimetypes
 from apwal import *
 
-from apwal.http import HttpResponse,HttpPlainText
+from apwal.http import HttpResponse,HttpPlainText,serve_file
 
 __all__ = [
 	'DirListing',
@@ -58,7 +58,7 @@ class DirListing(Pluggable):
 			try:
 				fpath = os.path.join(self.params['root'],urlparams['target'])
 				mt,extension = mimetypes.guess_type(fpath)
-				return HttpResponse(open(fpath, 'r').read(),mt)
+				return serve_file(self.request,fpath,mt)
 			except OSError,e:
 				return HttpResponse('Cannot read file !')
 			except IOError,e:
@@ -2,7 +2,7 @@ import os
 import mimetypes
 from apwal import *
 from apwal.core.exceptions import FileNotFound,ExternalRedirect
-from apwal.http import HttpResponse
+from apwal.http import serve_file
 
 @main
 class MediaServer(Pluggable):
@@ -24,12 +24,12 @@ class MediaServer(Pluggable):
 					# get ext
 					name,ext = os.path.splitext(required_media.upper())
 					if ext[1:] in exts:
-						return HttpResponse(open(f,'rb').read(),mt)
+						return serve_file(self.request,f,mt)
 					else:
 						# delegate to 404 handler
 						raise FileNotFound()
 				else:
-					return HttpResponse(open(f,'rb').read(),mt)
+					return serve_file(self.request,f,mt)
 			else:
 				# delegate to 404 handler
 				raise FileNotFound()